@@ -0,0 +1,446 @@
+#!/usr/bin/env python3
+
+"""micro-benchmarks of portal_filter operations at various passlist sizes
+
+Runs portal_filter against local stand-ins for libnftables (fake_nftables, an
+in-memory ruleset answering with `nft -j`-shaped JSON) and for the `conntrack`
+binary (a shell script placed first in PATH, so subprocess cost is kept).
+Clients are identified from a generated dnsmasq leases file (no ARP request).
+Operations suffixed with [mac] run in mac PASSLIST_MODE (MACs set).
+Activity history is kept in memory: the host's ACTIVITY_STATE_FILE is never
+read nor written, even when run as root.
+
+scapy (from portal_filter/requirements.txt) must be installed as portal_filter
+imports it. Root is not required.
+
+For each operation and passlist size, reports:
+    - ops/s: operations per second (mean over the run)
+    - p50_ms / max_ms: median and max duration of a single operation
+    - alloc_kib: peak of python memory allocated during a single operation
+      (tracemalloc, measured in a separate, untimed, pass)
+
+Results are saved as JSON (see --output) and can be compared with a previous
+run using --compare.
+
+    python benchmarks/bench_portal_filter.py --sizes 10,100 --compare before.json
+"""
+
+import argparse
+import datetime
+import ipaddress
+import json
+import os
+import pathlib
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional
+
+ROOT = pathlib.Path(__file__).parent.parent.resolve()
+sys.path.append(str(ROOT))
+sys.path.append(str(pathlib.Path(__file__).parent.resolve()))
+
+import fake_nftables  # noqa: E402
+
+sys.modules["nftables"] = fake_nftables
+# before portal_filter reads it: in-memory activity history only
+os.environ["ACTIVITY_STATE_FILE"] = ""
+
+import portal_filter  # noqa: E402
+from portal_filter.leases import LeaseIndex  # noqa: E402
+
+DEFAULT_SIZES = [10, 100, 1000, 5000]
+NETWORK = ipaddress.IPv4Network("10.0.0.0/16")
+
+# clients with an even last byte have an ESTABLISHED connection
+CONNTRACK_SCRIPT = """#!/bin/sh
+while [ $# -gt 0 ]; do
+    [ "$1" = "--src" ] && src="$2"
+    shift
+done
+case "$src" in
+    *[02468])
+        echo "tcp      6 431999 ESTABLISHED src=$src dst=93.184.216.34 \
+sport=51234 dport=443 src=93.184.216.34 dst=$src sport=443 dport=51234 \
+[ASSURED] mark=0 use=1"
+        echo "conntrack v1.4.7 (conntrack-tools): 1 flow entries have been shown." >&2
+        ;;
+    *)
+        echo "conntrack v1.4.7 (conntrack-tools): 0 flow entries have been shown." >&2
+        ;;
+esac
+"""
+
+
+def install_fake_conntrack() -> pathlib.Path:
+    """directory with a `conntrack` stand-in, prepended to PATH"""
+    bin_dir = pathlib.Path(tempfile.mkdtemp(prefix="fake-conntrack-"))
+    script = bin_dir.joinpath("conntrack")
+    script.write_text(CONNTRACK_SCRIPT)
+    script.chmod(0o755)
+    os.environ["PATH"] = f"{bin_dir}{os.pathsep}{os.environ.get('PATH', '')}"
+    return bin_dir
+
+
+def install_fake_leases() -> pathlib.Path:
+    """leases file (filled by populate) as only identity source"""
+    path = pathlib.Path(tempfile.mkdtemp(prefix="fake-leases-")).joinpath(
+        "dnsmasq.leases"
+    )
+    portal_filter.lease_index = LeaseIndex(path)
+    portal_filter.IDENTITY_SOURCES = ["leases"]
+    return path
+
+
+def client_ip(index: int) -> str:
+    return str(NETWORK.network_address + index + 1)
+
+
+def client_mac(index: int) -> str:
+    packed = (NETWORK.network_address + index + 1).packed
+    return "02:00:" + ":".join(f"{byte:02x}" for byte in packed)
+
+
+def allow(index: int, packets: int = 3):
+    """passlist client index as portal_filter would in current PASSLIST_MODE"""
+    if portal_filter.PASSLIST_MODE == "mac":
+        fake_nftables.table.allow_mac(
+            portal_filter.PASSLIST_MACS_SET, client_mac(index), packets=packets
+        )
+    else:
+        rules = fake_nftables.table.chains["CAPTIVE_PASSLIST"]
+        # last allow rule (worst case for matching)
+        fake_nftables.table.allow(
+            client_ip(index), index=len(rules) - 1, packets=packets
+        )
+
+
+def populate(size: int):
+    """reset stand-in ruleset to a passlist of size clients (and their leases)"""
+    mac_mode = portal_filter.PASSLIST_MODE == "mac"
+    fake_nftables.table = fake_nftables.Table(
+        macs_set=portal_filter.PASSLIST_MACS_SET if mac_mode else None
+    )
+    for index in range(size):
+        allow(index, packets=index)
+
+    # clients not passlisted (size and size + 1) are leased too
+    lease_index = portal_filter.lease_index
+    lease_index.path.write_text(
+        "".join(
+            f"1700000000 {client_mac(index)} {client_ip(index)} * *\n"
+            for index in range(size + 2)
+        )
+    )
+    lease_index.reload()
+
+
+def passlist_size() -> int:
+    """passlisted clients: allow rules and MACs set elements"""
+    return len(portal_filter.get_passlist_counters() or {})
+
+
+class Benchmark:
+    """an operation to measure. setup (untimed) prepares each iteration"""
+
+    def __init__(
+        self,
+        name: str,
+        operation: Callable[[Any], Any],
+        setup: Optional[Callable[[int], Any]] = None,
+        passlist_mode: str = "ip",
+    ):
+        self.name = name
+        self.operation = operation
+        self.setup = setup or (lambda size: None)
+        self.passlist_mode = passlist_mode
+
+    def run(self, size: int, min_time: float, min_iterations: int) -> Dict[str, Any]:
+        previous = portal_filter.PASSLIST_MODE
+        portal_filter.PASSLIST_MODE = self.passlist_mode
+        try:
+            return self.measure(size, min_time, min_iterations)
+        finally:
+            portal_filter.PASSLIST_MODE = previous
+
+    def measure(
+        self, size: int, min_time: float, min_iterations: int
+    ) -> Dict[str, Any]:
+        populate(size)
+        durations: List[float] = []
+        started_on = time.perf_counter()
+        while (
+            len(durations) < min_iterations
+            or time.perf_counter() - started_on < min_time
+        ):
+            arg = self.setup(size)
+            before = time.perf_counter()
+            self.operation(arg)
+            durations.append(time.perf_counter() - before)
+
+        allocs = []
+        tracemalloc.start()
+        for _ in range(min(min_iterations, 3)):
+            arg = self.setup(size)
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+            self.operation(arg)
+            allocs.append(tracemalloc.get_traced_memory()[1] - current)
+        tracemalloc.stop()
+
+        return {
+            "iterations": len(durations),
+            "ops_per_sec": len(durations) / sum(durations),
+            "p50_ms": statistics.median(durations) * 1000,
+            "max_ms": max(durations) * 1000,
+            "alloc_kib": statistics.median(allocs) / 1024,
+        }
+
+
+def setup_list_output(size: int) -> str:
+    return portal_filter.query_netfilter("list chain nat CAPTIVE_PASSLIST").output
+
+
+def setup_new_client(size: int) -> str:
+    """an IP not yet in passlist, removing previous iteration's one"""
+    ip_addr = client_ip(size)
+    portal_filter.remove_from_passlist(ip_addr)
+    return ip_addr
+
+
+def setup_registered_client(size: int) -> str:
+    """an IP present in passlist, added last (worst case for matching)"""
+    ip_addr = client_ip(size)
+    if not portal_filter.ip_in_passlist(ip_addr):
+        allow(size)
+    return ip_addr
+
+
+def setup_full_passlist(size: int):
+    if passlist_size() < size:
+        populate(size)
+
+
+def with_activity_source(source: str, func: Callable) -> Callable:
+    def wrapped(arg):
+        previous = portal_filter.ACTIVITY_SOURCE
+        portal_filter.ACTIVITY_SOURCE = source
+        try:
+            return func(arg)
+        finally:
+            portal_filter.ACTIVITY_SOURCE = previous
+
+    return wrapped
+
+
+def setup_counters_history(size: int):
+    """full passlist with counters history older than idle_after
+
+    Clients with an even last byte were active in last interval (as with
+    conntrack stand-in) so the counters path decides, not the conntrack fallback"""
+    setup_full_passlist(size)
+    tracker = portal_filter.activity_tracker
+    now = time.time()
+    tracker.counters = portal_filter.get_passlist_counters() or {}
+    tracker.first_seen_on = {
+        key: now - tracker.idle_after - tracker.interval for key in tracker.counters
+    }
+    tracker.last_active_on = {
+        key: now for key in tracker.counters if int(key.rsplit(".", 1)[1]) % 2 == 0
+    }
+
+
+def clear_with_counters(arg):
+    # forces a new snapshot as it would happen once per ACTIVITY_INTERVAL
+    portal_filter.activity_tracker.refreshed_on = None
+    return portal_filter.clear_passlist(inactives_only=True)
+
+
+BENCHMARKS = [
+    Benchmark(
+        "NftResult.json",
+        lambda output: portal_filter.NftResult(0, output, "").json,
+        setup=setup_list_output,
+    ),
+    Benchmark(
+        "ip_in_passlist[hit]",
+        portal_filter.ip_in_passlist,
+        setup=setup_registered_client,
+    ),
+    Benchmark(
+        "ip_in_passlist[miss]",
+        portal_filter.ip_in_passlist,
+        setup=lambda size: client_ip(size + 1),
+    ),
+    Benchmark(
+        "ack_client_registration",
+        portal_filter.ack_client_registration,
+        setup=setup_new_client,
+    ),
+    Benchmark(
+        "remove_from_passlist",
+        portal_filter.remove_from_passlist,
+        setup=setup_registered_client,
+    ),
+    Benchmark(
+        "get_passlist_counters",
+        lambda arg: portal_filter.get_passlist_counters(),
+    ),
+    Benchmark(
+        "clear_passlist[all]",
+        lambda arg: portal_filter.clear_passlist(inactives_only=False),
+        setup=setup_full_passlist,
+    ),
+    Benchmark(
+        "clear_passlist[conntrack]",
+        with_activity_source(
+            "conntrack", lambda arg: portal_filter.clear_passlist(inactives_only=True)
+        ),
+        setup=setup_full_passlist,
+    ),
+    Benchmark(
+        "clear_passlist[counters]",
+        with_activity_source("counters", clear_with_counters),
+        setup=setup_counters_history,
+    ),
+    Benchmark(
+        "ip_in_passlist[hit,mac]",
+        portal_filter.ip_in_passlist,
+        setup=setup_registered_client,
+        passlist_mode="mac",
+    ),
+    Benchmark(
+        "ip_in_passlist[miss,mac]",
+        portal_filter.ip_in_passlist,
+        setup=lambda size: client_ip(size + 1),
+        passlist_mode="mac",
+    ),
+    Benchmark(
+        "ack_client_registration[mac]",
+        portal_filter.ack_client_registration,
+        setup=setup_new_client,
+        passlist_mode="mac",
+    ),
+    Benchmark(
+        "remove_from_passlist[mac]",
+        portal_filter.remove_from_passlist,
+        setup=setup_registered_client,
+        passlist_mode="mac",
+    ),
+    Benchmark(
+        "get_passlist_counters[mac]",
+        lambda arg: portal_filter.get_passlist_counters(),
+        passlist_mode="mac",
+    ),
+    Benchmark(
+        "clear_passlist[conntrack,mac]",
+        with_activity_source(
+            "conntrack", lambda arg: portal_filter.clear_passlist(inactives_only=True)
+        ),
+        setup=setup_full_passlist,
+        passlist_mode="mac",
+    ),
+]
+
+
+def get_label() -> str:
+    """short git revision (with -dirty suffix) or timestamp"""
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=ROOT,
+            text=True,
+            capture_output=True,
+            check=True,
+        ).stdout.strip()
+    except Exception:
+        return datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+
+
+def print_results(results: Dict[str, Dict[str, Dict[str, Any]]], reference=None):
+    header = f"{'operation':<32}{'size':>6}{'ops/s':>12}{'p50_ms':>10}"
+    header += f"{'max_ms':>10}{'alloc_kib':>11}"
+    if reference:
+        header += f"{'vs ref':>9}"
+    print(header)
+    for name, by_size in results.items():
+        for size, result in by_size.items():
+            line = (
+                f"{name:<32}{size:>6}{result['ops_per_sec']:>12.1f}"
+                f"{result['p50_ms']:>10.3f}{result['max_ms']:>10.3f}"
+                f"{result['alloc_kib']:>11.1f}"
+            )
+            ref = (reference or {}).get(name, {}).get(size)
+            if ref:
+                line += f"{result['ops_per_sec'] / ref['ops_per_sec']:>8.2f}x"
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--sizes",
+        default=",".join(str(size) for size in DEFAULT_SIZES),
+        help="comma-separated passlist sizes",
+    )
+    parser.add_argument(
+        "--only", default="", help="comma-separated operations to run (all if unset)"
+    )
+    parser.add_argument(
+        "--min-time", type=float, default=1.0, help="min seconds per measure"
+    )
+    parser.add_argument(
+        "--min-iterations", type=int, default=3, help="min iterations per measure"
+    )
+    parser.add_argument(
+        "--output",
+        type=pathlib.Path,
+        help="where to save results. Defaults to bench-results/<git-describe>.json",
+    )
+    parser.add_argument(
+        "--compare", type=pathlib.Path, help="previous results to compare with"
+    )
+    args = parser.parse_args()
+
+    install_fake_conntrack()
+    install_fake_leases()
+    sizes = [int(size) for size in args.sizes.split(",")]
+    only = [name for name in args.only.split(",") if name]
+
+    results: Dict[str, Dict[str, Dict[str, Any]]] = {}
+    for benchmark in BENCHMARKS:
+        if only and benchmark.name not in only:
+            continue
+        for size in sizes:
+            print(f"running {benchmark.name} with {size} clients…", file=sys.stderr)
+            results.setdefault(benchmark.name, {})[str(size)] = benchmark.run(
+                size, min_time=args.min_time, min_iterations=args.min_iterations
+            )
+
+    label = get_label()
+    output = args.output or ROOT.joinpath("bench-results", f"{label}.json")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(
+        json.dumps(
+            {
+                "label": label,
+                "date": datetime.datetime.now().isoformat(),
+                "python": sys.version.split()[0],
+                "results": results,
+            },
+            indent=2,
+        )
+    )
+
+    reference = None
+    if args.compare:
+        reference = json.loads(args.compare.read_text())["results"]
+    print_results(results, reference)
+    print(f"results saved to {output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+"""local stand-in for the key-value server used by the `kv` users backend
+
+Speaks enough of the redis protocol (RESP2) for portal.backends.KVBackend:
+PING, GET, SET, MGET, MSET, DEL, EXISTS, FLUSHDB, PUBLISH and SUBSCRIBE. Other
+commands (such as the CLIENT SETINFO redis-py sends on connect) get an error
+reply.
+
+    python benchmarks/fake_kv_server.py --port 6379
+    BACKEND=kv KV_URL=redis://127.0.0.1:6379/0 python entrypoint.py
+
+Can also be started in-process with `serve()`, counting commands it receives.
+"""
+
+import argparse
+import collections
+import socketserver
+import threading
+from typing import Dict, List, Optional, Set
+
+
+class Store:
+    def __init__(self):
+        self.data: Dict[bytes, bytes] = {}
+        self.lock = threading.Lock()
+        self.commands = collections.Counter()
+        # channel: handlers of connections subscribed to it
+        self.subscribers: Dict[bytes, Set["RespHandler"]] = collections.defaultdict(set)
+
+
+class RespHandler(socketserver.StreamRequestHandler):
+    def read_command(self) -> Optional[List[bytes]]:
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            # inline command
+            return line.strip().split()
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def write(self, value):
+        if value is None:
+            self.wfile.write(b"$-1\r\n")
+        elif isinstance(value, int):
+            self.wfile.write(b":%d\r\n" % value)
+        elif isinstance(value, bytes):
+            self.wfile.write(b"$%d\r\n%s\r\n" % (len(value), value))
+        elif isinstance(value, list):
+            self.wfile.write(b"*%d\r\n" % len(value))
+            for item in value:
+                self.write(item)
+        elif isinstance(value, Exception):
+            self.wfile.write(f"-ERR {value}\r\n".encode("utf-8"))
+        else:
+            self.wfile.write(f"+{value}\r\n".encode("utf-8"))
+
+    def execute(self, name: str, args: List[bytes]):
+        store: Store = self.server.store
+        store.commands[name] += 1
+        data = store.data
+        with store.lock:
+            if name == "PING":
+                return "PONG"
+            if name == "GET":
+                return data.get(args[0])
+            if name == "SET":
+                data[args[0]] = args[1]
+                return "OK"
+            if name == "MGET":
+                return [data.get(key) for key in args]
+            if name == "MSET":
+                data.update(zip(args[::2], args[1::2]))
+                return "OK"
+            if name == "DEL":
+                return sum(data.pop(key, None) is not None for key in args)
+            if name == "EXISTS":
+                return sum(key in data for key in args)
+            if name == "FLUSHDB":
+                data.clear()
+                return "OK"
+            if name == "PUBLISH":
+                subscribers = list(store.subscribers.get(args[0], []))
+                for handler in subscribers:
+                    handler.push([b"message", args[0], args[1]])
+                return len(subscribers)
+        return ValueError(f"unknown command '{name}'")
+
+    def subscribe(self, channels: List[bytes]) -> List[list]:
+        store: Store = self.server.store
+        store.commands["SUBSCRIBE"] += 1
+        replies = []
+        with store.lock:
+            for channel in channels:
+                store.subscribers[channel].add(self)
+                self.channels.add(channel)
+                replies.append([b"subscribe", channel, len(self.channels)])
+        return replies
+
+    def push(self, value):
+        """send value to this connection (from another connection's thread)"""
+        with self.write_lock:
+            try:
+                self.write(value)
+                self.wfile.flush()
+            except OSError:
+                # disconnected, unsubscribed once its handler finishes
+                pass
+
+    def handle(self):
+        self.channels: Set[bytes] = set()
+        self.write_lock = threading.Lock()
+        while command := self.read_command():
+            name = command[0].decode("utf-8").upper()
+            if name == "SUBSCRIBE":
+                replies = self.subscribe(command[1:])
+            else:
+                replies = [self.execute(name, command[1:])]
+            with self.write_lock:
+                for reply in replies:
+                    self.write(reply)
+                self.wfile.flush()
+
+    def finish(self):
+        store: Store = self.server.store
+        with store.lock:
+            for channel in self.channels:
+                store.subscribers[channel].discard(self)
+        super().finish()
+
+
+class Server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address):
+        super().__init__(address, RespHandler)
+        self.store = Store()
+
+
+def serve(host: str = "127.0.0.1", port: int = 0) -> Server:
+    """server running in a background thread (port 0 picks a free one)"""
+    server = Server((host, port))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6379)
+    args = parser.parse_args()
+
+    with Server((args.host, args.port)) as server:
+        print(f"listening on {args.host}:{args.port}")
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+"""local stand-in for the `nftables` python binding (libnftables)
+
+Keeps an in-memory nat table shaped like the one portal_filter.setup_capture
+creates and answers the commands portal_filter sends with JSON payloads
+matching `nft -j` output (same keys, nesting and metainfo) so that decoding
+and rule-matching costs are representative.
+
+Only the handful of commands portal_filter uses are understood (including
+the MACs set of its mac PASSLIST_MODE). Others fail with rc=1 like
+libnftables would on a syntax error."""
+
+import json
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+METAINFO = {
+    "metainfo": {
+        "version": "1.0.6",
+        "release_name": "Lester Gooch #5",
+        "json_schema_version": 1,
+    }
+}
+
+LIST_CHAIN_RE = re.compile(r"^list chain (?:ip )?nat (?P<chain>\S+)$")
+INSERT_RULE_RE = re.compile(
+    r"^insert rule ip nat (?P<chain>\S+) index (?P<index>\d+) "
+    r"ip saddr (?P<ip>\S+) counter accept comment \"(?P<comment>[^\"]*)\"$"
+)
+DELETE_RULE_RE = re.compile(
+    r"^delete rule ip nat (?P<chain>\S+) handle (?P<handle>\d+)$"
+)
+SET_RULE_RE = re.compile(
+    r"^(?:insert rule ip nat (?P<chain>\S+) index (?P<index>\d+)"
+    r"|add rule ip nat (?P<appended_to>\S+)) "
+    r"ether saddr @(?P<set>\S+) counter accept comment \"(?P<comment>[^\"]*)\"$"
+)
+ADD_SET_RE = re.compile(
+    r"^add set ip nat (?P<set>\S+) \{ type ether_addr; counter; \}$"
+)
+LIST_SET_RE = re.compile(r"^list set ip nat (?P<set>\S+)$")
+ELEMENT_RE = re.compile(
+    r"^(?P<action>add|get|delete) element ip nat (?P<set>\S+) "
+    r"\{ (?P<elements>[^}]*) \}$"
+)
+NO_SUCH_FILE = "Error: Could not process rule: No such file or directory\n"
+
+
+class Table:
+    """nat table with a CAPTIVE_PASSLIST chain as left by setup_capture
+
+    With macs_set, as left in mac PASSLIST_MODE: with that set of MACs and its
+    accept rule"""
+
+    def __init__(
+        self, captured_address: str = "198.51.100.1", macs_set: Optional[str] = None
+    ):
+        self.next_handle = 1
+        self.chain_handle = self.new_handle()
+        self.chains: Dict[str, List[Dict[str, Any]]] = {"CAPTIVE_PASSLIST": []}
+        # set name: (handle, {MAC: counter})
+        self.sets: Dict[str, Tuple[int, Dict[str, Dict[str, Any]]]] = {}
+        for port, name in ((80, "captive_http"), (443, "captive_https")):
+            self.chains["CAPTIVE_PASSLIST"].append(
+                self.rule(
+                    "CAPTIVE_PASSLIST",
+                    [
+                        self.match("ip", "daddr", captured_address),
+                        self.match("tcp", "dport", port),
+                        self.counter(),
+                        {"return": None},
+                    ],
+                    f"return derived addr to calling chain ({name})",
+                )
+            )
+        self.chains["CAPTIVE_PASSLIST"].append(
+            self.rule(
+                "CAPTIVE_PASSLIST",
+                [
+                    self.match("ip", "protocol", "tcp"),
+                    self.counter(packets=9951, bytes_=634194),
+                    {"return": None},
+                ],
+                "return non-accepted to calling chain (captive_httpx)",
+            )
+        )
+        if macs_set:
+            self.add_set(macs_set)
+            self.add_set_rule(macs_set, "allow hosts", index=2)
+
+    def new_handle(self) -> int:
+        handle = self.next_handle
+        self.next_handle += 1
+        return handle
+
+    @staticmethod
+    def match(protocol: str, field: str, value: Any) -> Dict[str, Any]:
+        return {
+            "match": {
+                "op": "==",
+                "left": {"payload": {"protocol": protocol, "field": field}},
+                "right": value,
+            }
+        }
+
+    @staticmethod
+    def counter(packets: int = 0, bytes_: int = 0) -> Dict[str, Any]:
+        return {"counter": {"packets": packets, "bytes": bytes_}}
+
+    def rule(self, chain: str, expr: List[Dict[str, Any]], comment: str):
+        return {
+            "rule": {
+                "family": "ip",
+                "table": "nat",
+                "chain": chain,
+                "handle": self.new_handle(),
+                "comment": comment,
+                "expr": expr,
+            }
+        }
+
+    def allow(self, ip_addr: str, index: int = 2, packets: int = 3) -> int:
+        """insert an allow-host rule for ip_addr, returning its handle"""
+        rule = self.rule(
+            "CAPTIVE_PASSLIST",
+            [
+                self.match("ip", "saddr", ip_addr),
+                self.counter(packets=packets, bytes_=packets * 64),
+                {"accept": None},
+            ],
+            "allow host",
+        )
+        self.chains["CAPTIVE_PASSLIST"].insert(index, rule)
+        return rule["rule"]["handle"]
+
+    def add_set(self, name: str):
+        if name not in self.sets:
+            self.sets[name] = (self.new_handle(), {})
+
+    def add_set_rule(self, name: str, comment: str, index: Optional[int] = None):
+        """rule accepting members of set name, inserted at index or appended"""
+        rules = self.chains["CAPTIVE_PASSLIST"]
+        rule = self.rule(
+            "CAPTIVE_PASSLIST",
+            [
+                self.match("ether", "saddr", f"@{name}"),
+                self.counter(),
+                {"accept": None},
+            ],
+            comment,
+        )
+        rules.insert(len(rules) if index is None else index, rule)
+
+    def allow_mac(self, name: str, hw_addr: str, packets: int = 3):
+        """add hw_addr to set name (as nft, MACs are lower-cased)"""
+        self.sets[name][1][hw_addr.lower()] = self.counter(
+            packets=packets, bytes_=packets * 64
+        )["counter"]
+
+    def list_set(self, name: str, only: Optional[List[str]] = None) -> Dict[str, Any]:
+        handle, elements = self.sets[name]
+        entry = {
+            "family": "ip",
+            "name": name,
+            "table": "nat",
+            "type": "ether_addr",
+            "handle": handle,
+            "flags": ["counter"],
+        }
+        members = [
+            {"elem": {"val": hw_addr, "counter": dict(counter)}}
+            for hw_addr, counter in elements.items()
+            if only is None or hw_addr in only
+        ]
+        # no elem key on empty sets
+        if members:
+            entry["elem"] = members
+        return {"nftables": [METAINFO, {"set": entry}]}
+
+    def delete(self, chain: str, handle: int) -> bool:
+        rules = self.chains.get(chain, [])
+        for index, rule in enumerate(rules):
+            if rule["rule"]["handle"] == handle:
+                del rules[index]
+                return True
+        return False
+
+    def list_chain(self, chain: str) -> Dict[str, Any]:
+        return {
+            "nftables": [
+                METAINFO,
+                {
+                    "chain": {
+                        "family": "ip",
+                        "table": "nat",
+                        "name": chain,
+                        "handle": self.chain_handle,
+                    }
+                },
+                *self.chains[chain],
+            ]
+        }
+
+
+# shared by all Nftables instances, like the kernel's ruleset
+table = Table()
+
+
+class Nftables:
+    """subset of nftables.Nftables used by portal_filter"""
+
+    def __init__(self, *args, **kwargs):
+        self.json_output = False
+
+    def set_json_output(self, value: bool):
+        self.json_output = value
+
+    def cmd(self, command: str) -> Tuple[int, str, str]:
+        if match := LIST_CHAIN_RE.match(command):
+            if match.group("chain") not in table.chains:
+                return 1, "", "Error: No such file or directory\n"
+            return 0, json.dumps(table.list_chain(match.group("chain"))), ""
+
+        if match := INSERT_RULE_RE.match(command):
+            table.allow(match.group("ip"), index=int(match.group("index")), packets=0)
+            return 0, "", ""
+
+        if match := DELETE_RULE_RE.match(command):
+            if table.delete(match.group("chain"), int(match.group("handle"))):
+                return 0, "", ""
+            return 1, "", NO_SUCH_FILE
+
+        if match := SET_RULE_RE.match(command):
+            chain = match.group("chain") or match.group("appended_to")
+            if chain not in table.chains or match.group("set") not in table.sets:
+                return 1, "", NO_SUCH_FILE
+            index = match.group("index")
+            table.add_set_rule(
+                match.group("set"),
+                match.group("comment"),
+                index=int(index) if index is not None else None,
+            )
+            return 0, "", ""
+
+        if match := ADD_SET_RE.match(command):
+            table.add_set(match.group("set"))
+            return 0, "", ""
+
+        if match := LIST_SET_RE.match(command):
+            if match.group("set") not in table.sets:
+                return 1, "", "Error: No such file or directory\n"
+            return 0, json.dumps(table.list_set(match.group("set"))), ""
+
+        if match := ELEMENT_RE.match(command):
+            return self.element(
+                match.group("action"),
+                match.group("set"),
+                [
+                    value.strip().lower()
+                    for value in match.group("elements").split(",")
+                    if value.strip()
+                ],
+            )
+
+        return 1, "", f"Error: syntax error, unsupported by stand-in: {command}\n"
+
+    @staticmethod
+    def element(action: str, name: str, hw_addrs: List[str]) -> Tuple[int, str, str]:
+        if name not in table.sets:
+            return 1, "", NO_SUCH_FILE
+        elements = table.sets[name][1]
+        if action == "add":
+            # existing elements are kept, with their counters
+            for hw_addr in hw_addrs:
+                if hw_addr not in elements:
+                    table.allow_mac(name, hw_addr, packets=0)
+            return 0, "", ""
+        if any(hw_addr not in elements for hw_addr in hw_addrs):
+            return 1, "", NO_SUCH_FILE
+        if action == "get":
+            return 0, json.dumps(table.list_set(name, only=hw_addrs)), ""
+        for hw_addr in hw_addrs:
+            del elements[hw_addr]
+        return 0, "", ""
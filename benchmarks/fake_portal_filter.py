@@ -0,0 +1,79 @@
+"""counting stand-in for the portal filter API, used when replaying traces
+
+Keeps an in-memory passlist and counts the calls that would hit the kernel
+with portal_filter: nft queries, conntrack subprocesses and ARP lookups.
+An optional delay (seconds, per kind of call) simulates their cost.
+
+MAC addresses are derived from IPs (02:00:<ip bytes>)."""
+
+import collections
+import ipaddress
+import threading
+import time
+
+calls = collections.Counter()
+delays = {"nft": 0.0, "conntrack": 0.0, "arp": 0.0}
+passlist = set()
+lock = threading.Lock()
+
+
+def count(kind: str):
+    with lock:
+        calls[kind] += 1
+    if delays.get(kind):
+        time.sleep(delays[kind])
+
+
+def reset():
+    with lock:
+        calls.clear()
+        passlist.clear()
+
+
+def initial_setup(**kwargs):
+    count("nft")
+    return True, []
+
+
+def ack_client_registration(ip_addr: str) -> bool:
+    # ip_in_passlist query then insert
+    count("nft")
+    if ip_addr in passlist:
+        return False
+    count("nft")
+    passlist.add(ip_addr)
+    return True
+
+
+def get_identifier_for(ip_addr: str, default="aa:bb:cc:dd:ee:ff") -> str:
+    count("arp")
+    try:
+        packed = ipaddress.IPv4Address(ip_addr).packed
+    except Exception:
+        return default
+    return "02:00:" + ":".join(f"{byte:02x}" for byte in packed)
+
+
+def is_client_active(ip_addr: str) -> bool:
+    count("conntrack")
+    return ip_addr in passlist
+
+
+def ip_in_passlist(ip_addr: str) -> bool:
+    count("nft")
+    return ip_addr in passlist
+
+
+def migrate_client(hw_addr: str, old_ip_addr: str, new_ip_addr: str) -> bool:
+    if hw_addr == "aa:bb:cc:dd:ee:ff":
+        return False
+    # old_ip_addr's current holder
+    if get_identifier_for(old_ip_addr) != hw_addr:
+        return False
+    count("nft")
+    if old_ip_addr not in passlist:
+        return False
+    count("nft")
+    passlist.discard(old_ip_addr)
+    passlist.add(new_ip_addr)
+    return True
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+"""replay a recorded portal trace (see portal/trace.py) against the web app
+
+Requests are sent (in-process, via WSGI) with their original inter-arrival
+timing, divided by --speed (0 sends them as fast as possible). Each recorded
+client gets its own synthetic IP and a representative User-Agent of its class.
+
+The portal uses a counting stand-in filter (fake_portal_filter) and a fresh
+database (unless DB_PATH or BACKEND are set), so reported counts are:
+    - db: users backend reads and writes (get_many/put_many)
+    - nft, conntrack, arp: calls that would reach the kernel via portal_filter
+
+    TRACE_PATH=/data/trace.jsonl uwsgi --ini uwsgi.ini   # on the hotspot
+    python benchmarks/replay.py /data/trace.jsonl --speed 10
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import ipaddress
+import json
+import os
+import pathlib
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List
+
+ROOT = pathlib.Path(__file__).parent.parent.resolve()
+sys.path.append(str(ROOT))
+sys.path.append(str(pathlib.Path(__file__).parent.resolve()))
+
+USER_AGENTS = {
+    "android": "Dalvik/2.1.0 (Linux; U; Android 13; Pixel 6 Build/TQ3A.230805.001)",
+    "apple": "CaptiveNetworkSupport-481.0.1 wispr",
+    "windows": "Microsoft NCSI",
+    "linux": "NetworkManager/1.42.4",
+    "other": "Mozilla/5.0 (X11; rv:120.0) Gecko/20100101 Firefox/120.0",
+}
+NETWORK = ipaddress.IPv4Network("10.0.0.0/16")
+
+
+def load_trace(path: pathlib.Path) -> List[Dict]:
+    entries = [json.loads(line) for line in path.read_text().splitlines() if line]
+    return sorted(entries, key=lambda entry: entry["t"])
+
+
+def percentile(values: List[float], ratio: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * ratio))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("trace", type=pathlib.Path, help="trace file to replay")
+    parser.add_argument(
+        "--speed", type=float, default=1.0, help="acceleration (0: no waiting)"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=8, help="max concurrent requests"
+    )
+    for kind in ("nft", "conntrack", "arp"):
+        parser.add_argument(
+            f"--{kind}-delay",
+            type=float,
+            default=0.0,
+            help=f"simulated duration (s) of each {kind} call",
+        )
+    args = parser.parse_args()
+
+    os.environ["FILTER_MODULE"] = "fake_portal_filter"
+    # as many request threads as uwsgi `threads`
+    os.environ["REQUEST_THREADS"] = str(args.workers)
+    os.environ.pop("TRACE_PATH", None)
+    if not os.getenv("DB_PATH"):
+        os.environ["DB_PATH"] = str(
+            pathlib.Path(tempfile.mkdtemp(prefix="replay-")).joinpath("users.db")
+        )
+
+    import fake_portal_filter
+
+    from portal import database
+    from portal.web import app
+
+    for kind in fake_portal_filter.delays:
+        fake_portal_filter.delays[kind] = getattr(args, f"{kind}_delay")
+
+    db_calls = collections.Counter()
+    db_lock = threading.Lock()
+
+    def counted(func):
+        def wrapper(*args, **kwargs):
+            with db_lock:
+                db_calls["db"] += 1
+            return func(*args, **kwargs)
+
+        return wrapper
+
+    for method in ("get_many", "put_many"):
+        setattr(database.backend, method, counted(getattr(database.backend, method)))
+
+    entries = load_trace(args.trace)
+    if not entries:
+        print("empty trace", file=sys.stderr)
+        return
+    clients: Dict[str, str] = {}
+    for entry in entries:
+        clients.setdefault(entry["c"], str(NETWORK.network_address + len(clients) + 1))
+
+    latencies: Dict[str, List[float]] = collections.defaultdict(list)
+    lags: List[float] = []
+    lock = threading.Lock()
+    local = threading.local()
+
+    def send(entry: Dict, scheduled: float):
+        if not hasattr(local, "client"):
+            local.client = app.test_client()
+        started = time.perf_counter()
+        local.client.open(
+            entry["p"],
+            method=entry.get("m", "GET"),
+            base_url=f"http://{entry['h']}",
+            headers={
+                "User-Agent": USER_AGENTS.get(entry["ua"], USER_AGENTS["other"]),
+                "X-Forwarded-For": clients[entry["c"]],
+            },
+        )
+        duration = (time.perf_counter() - started) * 1000
+        with lock:
+            latencies[entry["ua"]].append(duration)
+            latencies["all"].append(duration)
+            lags.append((started - scheduled) * 1000)
+
+    first = entries[0]["t"]
+    replay_started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = []
+        for entry in entries:
+            scheduled = replay_started
+            if args.speed:
+                scheduled += (entry["t"] - first) / args.speed
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            futures.append(executor.submit(send, entry, scheduled))
+        for future in futures:
+            future.result()
+    elapsed = time.perf_counter() - replay_started
+
+    print(
+        f"replayed {len(entries)} requests from {len(clients)} clients "
+        f"in {elapsed:.1f}s (speed {args.speed or 'max'})"
+    )
+    print(f"{'ua':<10}{'count':>7}{'p50_ms':>9}{'p90_ms':>9}{'p99_ms':>9}{'max_ms':>9}")
+    for name, values in sorted(latencies.items()):
+        print(
+            f"{name:<10}{len(values):>7}{statistics.median(values):>9.2f}"
+            f"{percentile(values, 0.9):>9.2f}{percentile(values, 0.99):>9.2f}"
+            f"{max(values):>9.2f}"
+        )
+    if args.speed:
+        print(f"scheduling lag p99: {percentile(lags, 0.99):.2f}ms")
+
+    counts = dict(db_calls, **fake_portal_filter.calls)
+    print(f"{'calls':<10}{'total':>7}{'per_req':>9}")
+    for kind in ("db", "nft", "conntrack", "arp"):
+        total = counts.get(kind, 0)
+        print(f"{kind:<10}{total:>7}{total / len(entries):>9.2f}")
+
+    from portal.breakers import get_stats
+
+    for name, stats in get_stats().items():
+        if stats.get("degraded"):
+            print(f"{name}: {stats['degraded']} degraded answers ({stats})")
+
+
+if __name__ == "__main__":
+    main()
@@ -32,3 +32,8 @@ def is_client_active(**kwargs) -> bool:
 def ip_in_passlist(**kwargs) -> bool:
     logger.info(f"called ip_in_passlist with {kwargs=}")
     return False
+
+
+def migrate_client(**kwargs) -> bool:
+    logger.info(f"called migrate_client with {kwargs=}")
+    return False
@@ -0,0 +1,276 @@
+"""Storage backends for users records
+
+A record is a dict of User fields, keyed by its hw_addr. Backends store and
+retrieve them, by batches.
+
+- sqlite: local SQLite file (Conf.db_path). Default.
+- memory: process memory. Lost on restart, not shared between processes.
+- kv: networked key-value store (redis protocol, Conf.kv_url) shared by several
+  portal nodes so a registration covers a device across all of them.
+  Reads go through a client-side cache, invalidated by other processes' and
+  nodes' writes (published on the store) and expiring after Conf.kv_cache_ttl.
+"""
+
+import datetime
+import json
+import os
+import threading
+import time
+import uuid
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import peewee
+
+from portal.constants import Conf
+
+logger = Conf.logger
+
+Record = Dict[str, Any]
+
+DATETIME_FIELDS = ("last_seen_on", "registered_on")
+# seconds before subscribing again to invalidations after an error
+RESUBSCRIBE_DELAY = 5
+
+
+class Backend:
+    """users records storage, keyed by hw_addr"""
+
+    # whether records are shared with other portal nodes
+    is_shared: bool = False
+
+    def get_many(self, hw_addrs: Iterable[str]) -> Dict[str, Record]:
+        """records of hw_addrs that are present, by hw_addr"""
+        raise NotImplementedError()
+
+    def put_many(self, records: Iterable[Record]):
+        """create or replace records"""
+        raise NotImplementedError()
+
+    def get(self, hw_addr: str) -> Optional[Record]:
+        return self.get_many([hw_addr]).get(hw_addr)
+
+    def put(self, record: Record):
+        self.put_many([record])
+
+
+class MemoryBackend(Backend):
+    def __init__(self):
+        self.records: Dict[str, Record] = {}
+
+    def get_many(self, hw_addrs: Iterable[str]) -> Dict[str, Record]:
+        return {
+            hw_addr: dict(self.records[hw_addr])
+            for hw_addr in hw_addrs
+            if hw_addr in self.records
+        }
+
+    def put_many(self, records: Iterable[Record]):
+        for record in records:
+            self.records[record["hw_addr"]] = dict(record)
+
+
+class UserRecord(peewee.Model):
+    class Meta:
+        # table name of former User model, so existing DBs are kept
+        table_name = "user"
+
+    # ident-related fields
+    hw_addr = peewee.CharField(primary_key=True)
+    ip_addr = peewee.IPField()
+
+    # metadata
+    platform = peewee.CharField(null=True)
+    system = peewee.CharField(null=True)
+    system_version = peewee.FloatField(null=True)
+    browser = peewee.CharField(null=True)
+    browser_version = peewee.FloatField(null=True)
+    language = peewee.CharField(null=True)
+
+    # registration-related fields
+    last_seen_on = peewee.DateTimeField(default=datetime.datetime.now)
+    registered_on = peewee.DateTimeField(null=True)
+
+
+class SqliteBackend(Backend):
+    def __init__(self, db_path):
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = peewee.SqliteDatabase(str(db_path))
+        self.db.bind([UserRecord])
+        self.db.create_tables([UserRecord])
+
+    def get_many(self, hw_addrs: Iterable[str]) -> Dict[str, Record]:
+        hw_addrs = list(hw_addrs)
+        if not hw_addrs:
+            return {}
+        return {
+            record["hw_addr"]: record
+            for record in UserRecord.select()
+            .where(UserRecord.hw_addr.in_(hw_addrs))
+            .dicts()
+        }
+
+    def put_many(self, records: Iterable[Record]):
+        # fields only relevant to shared backends (registered_by, last_seen_by)
+        # have no column
+        columns = UserRecord._meta.fields
+        records = [
+            {key: value for key, value in record.items() if key in columns}
+            for record in records
+        ]
+        if not records:
+            return
+        with self.db.atomic():
+            UserRecord.insert_many(records).on_conflict_replace().execute()
+
+
+class KVBackend(Backend):
+    """records as JSON values in a redis-protocol key-value store
+
+    Reads are cached for cache_ttl seconds. Own writes update the cache.
+
+    Writes are published (hw_addrs) on an invalidation channel, which each
+    instance listens to (from a thread started on first read) to drop those
+    entries from its cache. Should the subscription fail, other processes'
+    writes are seen once the cached entry expired."""
+
+    is_shared = True
+
+    def __init__(self, url: str, cache_ttl: float, prefix: str = "portal:user:"):
+        # only required for this backend
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.cache_ttl = cache_ttl
+        self.prefix = prefix
+        self.channel = f"{prefix}invalidate"
+        # hw_addr: (expires_on, record or None if not present)
+        self.cache: Dict[str, Tuple[float, Optional[Record]]] = {}
+        # incremented on invalidations so reads they raced with are not cached
+        self.generation = 0
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # threads don't survive fork and each (uwsgi) worker has its own cache
+        self.cache.clear()
+        self.origin = uuid.uuid4().hex
+        self._listening = False
+        self._lock = threading.Lock()
+
+    def key(self, hw_addr: str) -> str:
+        return f"{self.prefix}{hw_addr}"
+
+    @staticmethod
+    def dumps(record: Record) -> str:
+        return json.dumps(
+            {
+                key: (
+                    value.isoformat() if isinstance(value, datetime.datetime) else value
+                )
+                for key, value in record.items()
+            }
+        )
+
+    @staticmethod
+    def loads(value: bytes) -> Record:
+        record = json.loads(value)
+        for key in DATETIME_FIELDS:
+            if record.get(key):
+                record[key] = datetime.datetime.fromisoformat(record[key])
+        return record
+
+    def invalidate(self, hw_addrs: Optional[Iterable[str]] = None):
+        """drop hw_addrs (all if None) from cache"""
+        self.generation += 1
+        if hw_addrs is None:
+            self.cache.clear()
+            return
+        for hw_addr in hw_addrs:
+            self.cache.pop(hw_addr, None)
+
+    def listen(self):
+        """start receiving invalidations (if not already)"""
+        with self._lock:
+            if self._listening:
+                return
+            threading.Thread(
+                target=self._listen, name="kv-invalidations", daemon=True
+            ).start()
+            self._listening = True
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                # writes might have been missed while not subscribed
+                self.invalidate()
+                for message in pubsub.listen():
+                    if message["type"] != "message":
+                        continue
+                    payload = json.loads(message["data"])
+                    if payload.get("origin") != self.origin:
+                        self.invalidate(payload.get("hw_addrs", []))
+            except Exception as exc:
+                logger.warning(
+                    f"not receiving kv invalidations ({exc}), "
+                    f"cache relies on {self.cache_ttl}s TTL"
+                )
+                time.sleep(RESUBSCRIBE_DELAY)
+
+    def get_many(self, hw_addrs: Iterable[str]) -> Dict[str, Record]:
+        if not self._listening:
+            self.listen()
+        now = time.monotonic()
+        records: Dict[str, Record] = {}
+        missing: List[str] = []
+        for hw_addr in hw_addrs:
+            expires_on, record = self.cache.get(hw_addr, (0, None))
+            if expires_on <= now:
+                missing.append(hw_addr)
+            elif record is not None:
+                records[hw_addr] = dict(record)
+
+        if missing:
+            generation = self.generation
+            values = self.client.mget([self.key(hw_addr) for hw_addr in missing])
+            for hw_addr, value in zip(missing, values):
+                record = self.loads(value) if value is not None else None
+                if self.generation == generation:
+                    self.cache[hw_addr] = (now + self.cache_ttl, record)
+                if record is not None:
+                    records[hw_addr] = dict(record)
+        return records
+
+    def put_many(self, records: Iterable[Record]):
+        records = list(records)
+        if not records:
+            return
+        pipeline = self.client.pipeline(transaction=False)
+        pipeline.mset(
+            {self.key(record["hw_addr"]): self.dumps(record) for record in records}
+        )
+        pipeline.publish(
+            self.channel,
+            json.dumps(
+                {
+                    "origin": self.origin,
+                    "hw_addrs": [record["hw_addr"] for record in records],
+                }
+            ),
+        )
+        pipeline.execute()
+        expires_on = time.monotonic() + self.cache_ttl
+        for record in records:
+            self.cache[record["hw_addr"]] = (expires_on, dict(record))
+
+
+def get_backend(name: str) -> Backend:
+    """backend instance from its name, configured via Conf"""
+    if name == "sqlite":
+        return SqliteBackend(Conf.db_path)
+    if name == "memory":
+        return MemoryBackend()
+    if name == "kv":
+        return KVBackend(Conf.kv_url, cache_ttl=Conf.kv_cache_ttl)
+    raise ValueError(f"unknown backend: {name}")
@@ -0,0 +1,230 @@
+"""Latency budgets and circuit breakers around filter module calls
+
+Each filter function is run in a worker thread and waited for at most
+Conf.filter_timeout seconds. A call timing out or raising counts as a failure;
+after Conf.breaker_threshold consecutive failures, the breaker opens and calls
+are not attempted for Conf.breaker_reset seconds. A single trial call is then
+let through: closing the breaker on success, reopening it on failure.
+
+Failed or short-circuited calls get a degraded answer instead: last known
+result for this IP (MAC, passlist verdict) or a safe default (client active,
+registration not acknowledged). Those are not fresh results: callers
+caching them (shared table) check answered_degraded() first.
+
+Hung calls (a stuck conntrack for instance) keep running in their thread but
+the portal doesn't wait for them. Each breaker has its own pool, of twice
+Conf.request_threads threads: each request thread waits for one call at a time,
+leaving as many for hung calls. Once all are running, a call waits for one to
+complete within its budget. If none does, it gets a degraded answer without
+counting as a failure (the breaker's state is unchanged): hung calls of one
+function neither pile up nor starve the others."""
+
+import collections
+import concurrent.futures
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+from portal.constants import DEFAULT_IDENTIFIER, Conf
+
+logger = Conf.logger
+
+# number of last known results kept per function
+LAST_KNOWN_SIZE = 4096
+
+# function name: degraded answer from (last known result or None, call kwargs)
+FALLBACKS: Dict[str, Callable[[Any, Dict[str, Any]], Any]] = {
+    "get_identifier_for": lambda last, kwargs: last
+    or kwargs.get("default", DEFAULT_IDENTIFIER),
+    "ip_in_passlist": lambda last, kwargs: last or False,
+    "is_client_active": lambda last, kwargs: True,
+    "ack_client_registration": lambda last, kwargs: False,
+    "migrate_client": lambda last, kwargs: False,
+}
+
+
+# whether last breaker call of each thread got a degraded answer
+_local = threading.local()
+
+
+def answered_degraded() -> bool:
+    """whether last breaker call made by this thread got a degraded answer"""
+    return getattr(_local, "degraded", False)
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(
+        self,
+        name: str,
+        func: Callable,
+        timeout: float,
+        threshold: int,
+        reset_after: float,
+        max_in_flight: Optional[int] = None,
+    ):
+        self.name = name
+        self.func = func
+        self.timeout = timeout
+        self.threshold = threshold
+        self.reset_after = reset_after
+        # running calls (per process)
+        self.max_in_flight = max_in_flight or 2 * Conf.request_threads
+        self.fallback = FALLBACKS[name]
+
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_on = 0.0
+        self.counts = collections.Counter()
+        self.last_known: collections.OrderedDict = collections.OrderedDict()
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # threads don't survive fork: each (uwsgi) worker gets its own pool
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(self.max_in_flight)
+        self.in_flight = 0
+        self.executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+
+    def allows_call(self) -> bool:
+        """whether call should be attempted (transitions to half-open if time)"""
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if (
+                self.state == self.OPEN
+                and time.monotonic() - self.opened_on >= self.reset_after
+            ):
+                # single trial call
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self, key: Optional[str], result: Any):
+        with self.lock:
+            if self.state != self.CLOSED:
+                logger.warning(f"{self.name} breaker closed ({dict(self.counts)})")
+            self.state = self.CLOSED
+            self.failures = 0
+            if key is not None:
+                self.last_known[key] = result
+                self.last_known.move_to_end(key)
+                if len(self.last_known) > LAST_KNOWN_SIZE:
+                    self.last_known.popitem(last=False)
+
+    def record_failure(self, reason: str):
+        with self.lock:
+            self.counts[reason] += 1
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (
+                self.state == self.CLOSED and self.failures >= self.threshold
+            ):
+                self.state = self.OPEN
+                self.opened_on = time.monotonic()
+                logger.warning(
+                    f"{self.name} breaker opened for {self.reset_after}s "
+                    f"after {self.failures} failure(s) ({dict(self.counts)})"
+                )
+
+    def record_saturated(self):
+        with self.lock:
+            self.counts["saturated"] += 1
+            # trial call not attempted: next one is
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+                self.opened_on = time.monotonic() - self.reset_after
+
+    def count(self, *names: str):
+        with self.lock:
+            for name in names:
+                self.counts[name] += 1
+
+    def submit(
+        self, args: tuple, kwargs: Dict[str, Any], wait: float
+    ) -> Optional[concurrent.futures.Future]:
+        """future of func's call, None if max_in_flight calls are still running
+        after wait seconds"""
+        if not self.slots.acquire(timeout=wait):
+            return None
+        with self.lock:
+            self.in_flight += 1
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.max_in_flight,
+                    thread_name_prefix=f"filter-{self.name}",
+                )
+            executor = self.executor
+        future = executor.submit(self.func, *args, **kwargs)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future: concurrent.futures.Future):
+        with self.lock:
+            self.in_flight -= 1
+        self.slots.release()
+
+    def degraded(self, key: Optional[str], kwargs: Dict[str, Any]) -> Any:
+        self.count("degraded")
+        _local.degraded = True
+        return self.fallback(self.last_known.get(key), kwargs)
+
+    def __call__(self, *args, **kwargs):
+        key = kwargs.get("ip_addr", args[0] if args else None)
+        _local.degraded = False
+        self.count("calls")
+        if not self.allows_call():
+            self.count("short_circuited")
+            logger.debug(f"{self.name} breaker open: degraded answer for {key}")
+            return self.degraded(key, kwargs)
+
+        deadline = time.monotonic() + self.timeout
+        future = self.submit(args, kwargs, wait=self.timeout)
+        if future is None:
+            # not this call's failure: previous ones are hung
+            logger.warning(f"{self.name}({key}): {self.max_in_flight} calls running")
+            self.record_saturated()
+            return self.degraded(key, kwargs)
+        try:
+            result = future.result(timeout=max(deadline - time.monotonic(), 0))
+        except concurrent.futures.TimeoutError:
+            logger.warning(f"{self.name}({key}) exceeded {self.timeout}s budget")
+            self.record_failure("timeouts")
+            return self.degraded(key, kwargs)
+        except Exception as exc:
+            logger.warning(f"{self.name}({key}) failed: {exc}")
+            self.record_failure("errors")
+            return self.degraded(key, kwargs)
+
+        self.record_success(key, result)
+        return result
+
+
+breakers: Dict[str, CircuitBreaker] = {}
+
+
+def with_breaker(name: str, func: Callable) -> Callable:
+    """func wrapped in a circuit breaker, if enabled and relevant to func"""
+    if not Conf.filter_timeout or name not in FALLBACKS:
+        return func
+    if name not in breakers:
+        breakers[name] = CircuitBreaker(
+            name,
+            func,
+            timeout=Conf.filter_timeout,
+            threshold=Conf.breaker_threshold,
+            reset_after=Conf.breaker_reset,
+        )
+    return breakers[name]
+
+
+def get_stats() -> Dict[str, Dict[str, Any]]:
+    """state and counts of each breaker"""
+    return {
+        name: {"state": breaker.state, "in_flight": breaker.in_flight, **breaker.counts}
+        for name, breaker in breakers.items()
+    }
@@ -2,11 +2,36 @@ import importlib
 import logging
 import os
 import pathlib
+import re
+import socket
 from dataclasses import dataclass
 from typing import Callable
 
 logging.basicConfig(level=logging.INFO)
 
+# returned by filter modules' get_identifier_for for clients they can't identify
+DEFAULT_IDENTIFIER = "aa:bb:cc:dd:ee:ff"
+MAC_RE = re.compile(r"^([0-9a-f]{2}:){5}[0-9a-f]{2}$", re.IGNORECASE)
+
+
+def is_valid_mac(hw_addr: str) -> bool:
+    """whether HW address string is a valid MAC (and not the default identifier)"""
+    return bool(
+        hw_addr and MAC_RE.match(hw_addr) and hw_addr.lower() != DEFAULT_IDENTIFIER
+    )
+
+
+def get_uwsgi_threads() -> int:
+    """request threads of each uwsgi worker (1 without threads or outside uwsgi)"""
+    try:
+        import uwsgi
+    except ImportError:
+        return 1
+    try:
+        return max(int(uwsgi.opt.get("threads", 1)), 1)
+    except (TypeError, ValueError):
+        return 1
+
 
 @dataclass
 class Config:
@@ -19,6 +44,19 @@ class Config:
     # impl & debug
     debug: bool = bool(os.getenv("DEBUG", False))
     db_path: pathlib.Path = pathlib.Path(os.getenv("DB_PATH", "portal-users.db"))
+    backend: str = os.getenv("BACKEND", "sqlite")
+    node_name: str = os.getenv("NODE_NAME", "") or socket.gethostname()
+    kv_url: str = os.getenv("KV_URL", "redis://localhost:6379/0")
+    kv_cache_ttl: int = int(os.getenv("KV_CACHE_TTL", "5"))
+    shared_table_path: str = os.getenv("SHARED_TABLE_PATH", "")
+    shared_table_slots: int = int(os.getenv("SHARED_TABLE_SLOTS", "4096"))
+    shared_table_ttl: int = int(os.getenv("SHARED_TABLE_TTL", "10"))
+    trace_path: str = os.getenv("TRACE_PATH", "")
+    trace_salt: str = os.getenv("TRACE_SALT", "")
+    filter_timeout: float = float(os.getenv("FILTER_TIMEOUT", "2"))
+    breaker_threshold: int = int(os.getenv("BREAKER_THRESHOLD", "3"))
+    breaker_reset: float = float(os.getenv("BREAKER_RESET", "30"))
+    request_threads: int = int(os.getenv("REQUEST_THREADS", "0")) or get_uwsgi_threads()
     filter_module: str = os.getenv("FILTER_MODULE", "dummy_portal_filter")
 
     # internal
@@ -40,7 +78,15 @@ class Config:
         return self.timeout_mn * 60
 
     def get_filter_func(self, name: str):
-        return getattr(self._filter_module, name)
+        # imported here as those depend on Conf
+        from portal.breakers import with_breaker
+
+        func = with_breaker(name, getattr(self._filter_module, name))
+        if self.shared_table_path:
+            from portal.shared_table import with_shared_table
+
+            func = with_shared_table(name, func)
+        return func
 
 
 Conf = Config()
@@ -1,52 +1,97 @@
 import datetime
+from dataclasses import asdict, dataclass, field, fields
 from typing import Any, Dict, Optional
 
-import peewee
+from portal.backends import Record, get_backend
+from portal.constants import Conf, is_valid_mac
+from portal.shared_table import table as shared_table
 
-from portal.constants import Conf
-
-Conf.db_path.parent.mkdir(parents=True, exist_ok=True)
-portal_db = peewee.SqliteDatabase(str(Conf.db_path))
+backend = get_backend(Conf.backend)
 is_client_active = Conf.get_filter_func("is_client_active")
 ip_in_passlist = Conf.get_filter_func("ip_in_passlist")
+migrate_client = Conf.get_filter_func("migrate_client")
 
 
-class User(peewee.Model):
-    class Meta:
-        database = portal_db
-
+@dataclass
+class User:
     # ident-related fields
-    hw_addr = peewee.CharField(primary_key=True)
-    ip_addr = peewee.IPField()
+    hw_addr: str
+    ip_addr: str
 
     # metadata
-    platform = peewee.CharField(null=True)
-    system = peewee.CharField(null=True)
-    system_version = peewee.FloatField(null=True)
-    browser = peewee.CharField(null=True)
-    browser_version = peewee.FloatField(null=True)
-    language = peewee.CharField(null=True)
+    platform: Optional[str] = None
+    system: Optional[str] = None
+    system_version: Optional[float] = None
+    browser: Optional[str] = None
+    browser_version: Optional[float] = None
+    language: Optional[str] = None
 
     # registration-related fields
-    last_seen_on = peewee.DateTimeField(default=datetime.datetime.now)
-    registered_on = peewee.DateTimeField(null=True)
+    last_seen_on: datetime.datetime = field(default_factory=datetime.datetime.now)
+    # Conf.node_name of the portal node it was last seen on (at ip_addr)
+    last_seen_by: Optional[str] = None
+    registered_on: Optional[datetime.datetime] = None
+    # Conf.node_name of the portal node it registered on (or was taken over by)
+    registered_by: Optional[str] = None
+
+    @classmethod
+    def from_record(cls, record: Record) -> "User":
+        names = {item.name for item in fields(cls)}
+        return cls(**{key: value for key, value in record.items() if key in names})
 
-    def save(self, *args, **kwargs):
+    def save(self):
         self.last_seen_on = datetime.datetime.now()
-        return super().save(*args, **kwargs)
+        self.last_seen_by = Conf.node_name
+        backend.put(asdict(self))
+
+    @property
+    def registration_is_valid(self) -> bool:
+        """whether registered and registration has not expired"""
+        if not self.registered_on:
+            return False
+
+        now = datetime.datetime.now()
+        return (
+            now > self.registered_on
+            and (now - self.registered_on).total_seconds() < Conf.timeout
+        )
+
+    @property
+    def registered_until(self) -> float:
+        """timestamp registration expires at (0 if not registered)"""
+        if not self.registered_on:
+            return 0.0
+        return self.registered_on.timestamp() + Conf.timeout
 
     @property
     def is_registered(self) -> bool:
         if not self.registered_on:
             return False
 
+        if shared_table:
+            registered = shared_table.is_registered(self.ip_addr, self.hw_addr)
+            if registered is not None:
+                return registered
+
         if not ip_in_passlist(ip_addr=self.ip_addr):
             return False
 
-        now = datetime.datetime.now()
+        return self.registration_is_valid
+
+    @property
+    def is_registered_elsewhere(self) -> bool:
+        """whether registered via another node sharing our backend
+
+        Such users are not in our passlist yet. Users registered on (or taken
+        over by) this node and no longer in passlist (cleared as inactive) are
+        not, nor are unidentified clients: they all share the default
+        identifier's record"""
         return (
-            now > self.registered_on
-            and (now - self.registered_on).total_seconds() < Conf.timeout
+            backend.is_shared
+            and is_valid_mac(self.hw_addr)
+            and self.registered_by not in (None, Conf.node_name)
+            and self.registration_is_valid
+            and not ip_in_passlist(ip_addr=self.ip_addr)
         )
 
     @property
@@ -55,22 +100,48 @@ class User(peewee.Model):
 
     def register(self, delay: Optional[int] = 0):
         self.registered_on = datetime.datetime.now() + datetime.timedelta(seconds=delay)
+        self.registered_by = Conf.node_name
+        self.save()
+        if shared_table:
+            shared_table.update(self.ip_addr, registered_until=self.registered_until)
+
+    def take_over_registration(self):
+        """record registration (made elsewhere) as this node's, once passlisted
+
+        Our clean-up then applies to it as to registrations made here: once
+        cleared as inactive, it is not passlisted again automatically"""
+        self.registered_by = Conf.node_name
         self.save()
 
+    @classmethod
+    def get(cls, hw_addr: str) -> Optional["User"]:
+        record = backend.get(hw_addr)
+        return cls.from_record(record) if record else None
+
     @classmethod
     def create_or_update(cls, hw_addr: str, ip_addr: str, extras: Dict[str, Any]):
-        data = {"ip_addr": ip_addr, "last_seen_on": datetime.datetime.now()}
-        try:
-            user, created = cls.get_or_create(hw_addr=hw_addr, defaults=data)
-        except peewee.IntegrityError:
-            # race condition is possible
-            user = cls.get(hw_addr=hw_addr)
-        extras.update(data)
+        user = cls.get(hw_addr) or cls(hw_addr=hw_addr, ip_addr=ip_addr)
+        # unidentified clients all share the default identifier: not a device.
+        # IP recorded by another node (shared backend) is one of its network's
+        if (
+            user.ip_addr != ip_addr
+            and is_valid_mac(hw_addr)
+            and (not backend.is_shared or user.last_seen_by == Conf.node_name)
+        ):
+            # known device got a new IP (DHCP renewal, roaming): move its passlisting
+            migrate_client(
+                hw_addr=hw_addr, old_ip_addr=user.ip_addr, new_ip_addr=ip_addr
+            )
+        extras.update({"ip_addr": ip_addr})
         for key, value in extras.items():
             if hasattr(user, key) and value is not None:
                 setattr(user, key, value)
         user.save()
+        values = {
+            "hw_addr": hw_addr,
+            "platform": user.platform,
+            "registered_until": user.registered_until,
+        }
+        if shared_table and not shared_table.matches(ip_addr, **values):
+            shared_table.update(ip_addr, **values)
         return user
-
-
-portal_db.create_tables([User])
@@ -1,3 +1,6 @@
+import re
+from typing import Optional
+
 import flask
 
 from portal.constants import Conf
@@ -44,6 +47,24 @@ LINUX_HOSTS = ["connectivity-check.ubuntu.com", "nmcheck.gnome.org"]
 FIREFOX_HOSTS = ["detectportal.firefox.com"]
 
 
+def platform_from_ua(ua: str) -> Optional[str]:
+    """platform (android, apple, windows, linux) from a User-Agent string"""
+    platform = None
+    if re.search(r"Android", ua):
+        platform = "android"
+    if re.search(r"CaptiveNetworkSupport", ua):
+        platform = "apple"
+    if re.search(r"(OS X|iPhone OS|iPad OS)", ua):
+        platform = platform or "apple"
+    if re.search(r"(Microsoft NCSI)", ua):
+        platform = "windows"
+    if re.search(r"Windows", ua):
+        platform = platform or "windows"
+    if re.search(r"Linux", ua):
+        platform = "linux"
+    return platform
+
+
 def is_google_request(request):
     return request.path == "/gen_204" or request.path == "/generate_204"
 
@@ -0,0 +1,358 @@
+"""Shared-memory per-IP table for all uwsgi workers
+
+Fixed-layout, mmap-backed file (in /dev/shm typically) holding, for each client
+IP, its MAC address, passlist and activity verdicts (with the time they were
+checked), registration expiry and platform code.
+
+Filter functions are wrapped so that fresh-enough (Conf.shared_table_ttl)
+answers are read from the table instead of querying the kernel in every worker.
+Degraded answers of circuit breakers (portal.breakers) are returned but not
+recorded, so they are not served to other workers as fresh verdicts.
+
+Readers don't lock: each record starts with a sequence number, odd while being
+written (seqlock). Writers are serialized with an exclusive flock on the file,
+so there is a single writer at any time. Memory use is constant (slots size).
+
+MAC addresses are returned lower-cased.
+
+Slot of an IP is its integer value modulo slots, with linear probing. When all
+probed slots are taken, the least recently updated one is reused.
+
+Layout version and slots are part of the file name: a worker with another
+layout (upgrade) or size uses its own file. Files in use are never resized."""
+
+import collections
+import contextlib
+import fcntl
+import functools
+import ipaddress
+import mmap
+import os
+import pathlib
+import struct
+import time
+from typing import Callable, Iterator, Optional
+
+from portal.breakers import answered_degraded
+from portal.constants import Conf
+
+logger = Conf.logger
+
+VERSION = 2
+MAGIC = b"PRTLTBL%d" % VERSION
+# magic, slots, record size
+HEADER = struct.Struct("<8sII")
+# seq, ip, mac, platform, flags, mac_on, passlist_on, active_on, registered_until
+RECORD = struct.Struct("<II6sBBdddd")
+SEQ = struct.Struct("<I")
+PROBES = 8
+# reads of a record being written before considering it missing
+READ_RETRIES = 100
+
+FLAG_PASSLISTED = 0x01
+FLAG_ACTIVE = 0x02
+
+PLATFORMS = ["", "android", "apple", "windows", "linux", "macos", "ios", "other"]
+
+Entry = collections.namedtuple(
+    "Entry",
+    [
+        "ip_addr",
+        "hw_addr",
+        "platform",
+        "flags",
+        "mac_on",
+        "passlist_on",
+        "active_on",
+        "registered_until",
+    ],
+)
+
+
+def ip_to_int(ip_addr: str) -> int:
+    """IPv4 as int, 0 (empty slot marker) if not a valid IPv4"""
+    try:
+        return int(ipaddress.IPv4Address(ip_addr))
+    except Exception:
+        return 0
+
+
+def mac_to_bytes(hw_addr: Optional[str]) -> bytes:
+    """6-bytes MAC, zeroes if not a valid MAC"""
+    try:
+        value = bytes.fromhex((hw_addr or "").replace(":", ""))
+    except ValueError:
+        return bytes(6)
+    return value if len(value) == 6 else bytes(6)
+
+
+def platform_code(platform: Optional[str]) -> int:
+    if not platform:
+        return 0
+    try:
+        return PLATFORMS.index(platform.lower())
+    except ValueError:
+        return PLATFORMS.index("other")
+
+
+class SharedTable:
+    def __init__(self, path: pathlib.Path, slots: int):
+        self.path = path
+        self.slots = slots
+        self.size = HEADER.size + slots * RECORD.size
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        with self.writing():
+            size = os.fstat(self.fd).st_size
+            if size == 0:
+                logger.info(f"initializing shared table at {path} ({slots} slots)")
+                os.ftruncate(self.fd, self.size)
+                os.pwrite(self.fd, HEADER.pack(MAGIC, slots, RECORD.size), 0)
+            is_valid = size in (0, self.size) and self._header_matches()
+        if not is_valid:
+            # might be mapped by other processes: not ours to resize
+            os.close(self.fd)
+            raise ValueError(f"{path} is not a v{VERSION} table of {slots} slots")
+        self.mm = mmap.mmap(self.fd, self.size, mmap.MAP_SHARED)
+        os.register_at_fork(after_in_child=self._reopen)
+
+    def _reopen(self):
+        # flock is bound to the open file description, which forks share
+        self.fd = os.open(self.path, os.O_RDWR)
+
+    def _header_matches(self) -> bool:
+        return os.pread(self.fd, HEADER.size, 0) == HEADER.pack(
+            MAGIC, self.slots, RECORD.size
+        )
+
+    @contextlib.contextmanager
+    def writing(self):
+        """exclusive write lock, shared by all processes"""
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def offsets(self, ip: int) -> Iterator[int]:
+        start = ip % self.slots
+        for probe in range(min(PROBES, self.slots)):
+            yield HEADER.size + ((start + probe) % self.slots) * RECORD.size
+
+    def read_at(self, offset: int) -> Optional[tuple]:
+        """record at offset, consistent (retries while being written)"""
+        for _ in range(READ_RETRIES):
+            seq = SEQ.unpack_from(self.mm, offset)[0]
+            if seq % 2:
+                continue
+            record = RECORD.unpack_from(self.mm, offset)
+            if SEQ.unpack_from(self.mm, offset)[0] == seq:
+                return record
+        return None
+
+    def get(self, ip_addr: str) -> Optional[Entry]:
+        """entry for ip_addr, if present"""
+        ip = ip_to_int(ip_addr)
+        if not ip:
+            return None
+        for offset in self.offsets(ip):
+            record = self.read_at(offset)
+            if record is None or record[1] == 0:
+                return None
+            if record[1] == ip:
+                _, _, mac, platform, *values = record
+                return Entry(
+                    ip_addr,
+                    ":".join(f"{byte:02x}" for byte in mac) if any(mac) else None,
+                    PLATFORMS[platform] if platform < len(PLATFORMS) else None,
+                    *values,
+                )
+        return None
+
+    def matches(
+        self,
+        ip_addr: str,
+        hw_addr: str,
+        platform: Optional[str],
+        registered_until: float = 0.0,
+    ) -> bool:
+        """whether ip_addr's entry has those user values already (lock-free)"""
+        entry = self.get(ip_addr)
+        return (
+            entry is not None
+            and entry.hw_addr == (hw_addr or "").lower()
+            and platform_code(entry.platform) == platform_code(platform)
+            and entry.registered_until == registered_until
+        )
+
+    def is_registered(self, ip_addr: str, hw_addr: str) -> Optional[bool]:
+        """whether hw_addr at ip_addr has an unexpired registration and is passlisted
+
+        None if not known from table: no registration expiry recorded for this
+        device or passlist verdict not fresh"""
+        entry = self.get(ip_addr)
+        if (
+            entry is None
+            or entry.hw_addr != (hw_addr or "").lower()
+            or not entry.registered_until
+            or not self.is_fresh(entry.passlist_on)
+        ):
+            return None
+        return time.time() < entry.registered_until and bool(
+            entry.flags & FLAG_PASSLISTED
+        )
+
+    def find_slot(self, ip: int) -> int:
+        """offset of ip's record, a free slot or the least recently updated one"""
+        oldest = None
+        for offset in self.offsets(ip):
+            record = RECORD.unpack_from(self.mm, offset)
+            if record[1] in (ip, 0):
+                return offset
+            updated_on = max(record[5:8])
+            if oldest is None or updated_on < oldest[0]:
+                oldest = (updated_on, offset)
+        return oldest[1]
+
+    def update(self, ip_addr: str, set_flags: int = 0, clear_flags: int = 0, **values):
+        """update (or create) ip_addr's entry with values (Entry fields)"""
+        ip = ip_to_int(ip_addr)
+        if not ip:
+            return
+        with self.writing():
+            offset = self.find_slot(ip)
+            seq, *fields = RECORD.unpack_from(self.mm, offset)
+            # odd if a writer died while writing
+            seq += seq % 2
+            if fields[0] != ip:
+                fields = [ip, bytes(6), 0, 0, 0.0, 0.0, 0.0, 0.0]
+
+            for key, value in values.items():
+                if key == "hw_addr":
+                    value = mac_to_bytes(value)
+                elif key == "platform":
+                    value = platform_code(value)
+                fields[Entry._fields.index(key)] = value
+            fields[3] = (fields[3] | set_flags) & ~clear_flags
+
+            SEQ.pack_into(self.mm, offset, (seq + 1) % 2**32)
+            RECORD.pack_into(self.mm, offset, (seq + 1) % 2**32, *fields)
+            SEQ.pack_into(self.mm, offset, (seq + 2) % 2**32)
+
+    def set_flag(self, ip_addr: str, flag: int, value: bool, **values):
+        if value:
+            self.update(ip_addr, set_flags=flag, **values)
+        else:
+            self.update(ip_addr, clear_flags=flag, **values)
+
+    @staticmethod
+    def is_fresh(checked_on: float) -> bool:
+        return time.time() - checked_on < Conf.shared_table_ttl
+
+
+def get_table_path(path: str, slots: int) -> pathlib.Path:
+    """actual path of the table for a (configured) path"""
+    return pathlib.Path(f"{path}.v{VERSION}.{slots}")
+
+
+def get_table() -> Optional[SharedTable]:
+    if not Conf.shared_table_path:
+        return None
+    path = get_table_path(Conf.shared_table_path, Conf.shared_table_slots)
+    try:
+        return SharedTable(path, Conf.shared_table_slots)
+    except Exception as exc:
+        logger.error(f"cannot use shared table at {path}: {exc}")
+        return None
+
+
+table = get_table()
+
+
+def cached_identifier_for(func: Callable) -> Callable:
+    @functools.wraps(func)
+    def wrapper(ip_addr: str, **kwargs):
+        entry = table.get(ip_addr)
+        if entry and entry.hw_addr and table.is_fresh(entry.mac_on):
+            return entry.hw_addr
+        hw_addr = func(ip_addr=ip_addr, **kwargs)
+        if not answered_degraded():
+            table.update(ip_addr, hw_addr=hw_addr, mac_on=time.time())
+        # same (lower) case whether it comes from table or not
+        return hw_addr.lower() if hw_addr else hw_addr
+
+    return wrapper
+
+
+def cached_in_passlist(func: Callable) -> Callable:
+    @functools.wraps(func)
+    def wrapper(ip_addr: str, **kwargs):
+        entry = table.get(ip_addr)
+        if entry and table.is_fresh(entry.passlist_on):
+            return bool(entry.flags & FLAG_PASSLISTED)
+        passlisted = func(ip_addr=ip_addr, **kwargs)
+        if not answered_degraded():
+            table.set_flag(
+                ip_addr, FLAG_PASSLISTED, bool(passlisted), passlist_on=time.time()
+            )
+        return passlisted
+
+    return wrapper
+
+
+def cached_client_active(func: Callable) -> Callable:
+    @functools.wraps(func)
+    def wrapper(ip_addr: str, **kwargs):
+        entry = table.get(ip_addr)
+        if entry and table.is_fresh(entry.active_on):
+            return bool(entry.flags & FLAG_ACTIVE)
+        active = func(ip_addr=ip_addr, **kwargs)
+        if not answered_degraded():
+            table.set_flag(ip_addr, FLAG_ACTIVE, bool(active), active_on=time.time())
+        return active
+
+    return wrapper
+
+
+def updating_registration(func: Callable) -> Callable:
+    @functools.wraps(func)
+    def wrapper(ip_addr: str, **kwargs):
+        added = func(ip_addr=ip_addr, **kwargs)
+        if added:
+            table.set_flag(ip_addr, FLAG_PASSLISTED, True, passlist_on=time.time())
+        else:
+            # might have been present already: check again on next read
+            table.update(ip_addr, passlist_on=0)
+        return added
+
+    return wrapper
+
+
+def updating_migration(func: Callable) -> Callable:
+    @functools.wraps(func)
+    def wrapper(hw_addr: str, old_ip_addr: str, new_ip_addr: str, **kwargs):
+        migrated = func(
+            hw_addr=hw_addr, old_ip_addr=old_ip_addr, new_ip_addr=new_ip_addr, **kwargs
+        )
+        # passlist verdicts of both IPs might have changed
+        for ip_addr in (old_ip_addr, new_ip_addr):
+            if table.get(ip_addr):
+                table.update(ip_addr, passlist_on=0)
+        return migrated
+
+    return wrapper
+
+
+WRAPPERS = {
+    "get_identifier_for": cached_identifier_for,
+    "ip_in_passlist": cached_in_passlist,
+    "is_client_active": cached_client_active,
+    "ack_client_registration": updating_registration,
+    "migrate_client": updating_migration,
+}
+
+
+def with_shared_table(name: str, func: Callable) -> Callable:
+    """func wrapped to use shared table, if enabled and relevant to func"""
+    if table is None or name not in WRAPPERS:
+        return func
+    return WRAPPERS[name](func)
@@ -0,0 +1,90 @@
+"""Opt-in recording of an anonymised trace of portal requests
+
+Enabled by setting Conf.trace_path. Each request is appended as a JSON line:
+
+    {"t": 1700000000.123, "d": 2.51, "m": "GET", "h": "captive.apple.com",
+     "p": "/hotspot-detect.html", "ua": "apple", "c": "5f2a9c0e1b7d", "s": 200}
+
+t: arrival time (epoch), d: duration (ms), m: method, h: host, p: path (without
+query string), ua: platform class of the User-Agent (not the UA itself),
+c: client identity (salted hash of its IP), s: response status.
+
+Salt is Conf.trace_salt or random (generated once, before uwsgi forks workers)
+so client identities can't be linked back to IPs.
+
+Traces are replayed with benchmarks/replay.py"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+import flask
+
+from portal.constants import Conf
+from portal.platforms import platform_from_ua
+
+logger = Conf.logger
+
+
+class Recorder:
+    def __init__(self, path: str, salt: str):
+        self.path = path
+        self.salt = salt.encode("utf-8")
+        self.lock = threading.Lock()
+        self.fd = None
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # each worker opens its own (appending) file descriptor
+        self.fd = None
+        self.lock = threading.Lock()
+
+    def client_id(self, ip_addr: str) -> str:
+        return hashlib.sha256(self.salt + ip_addr.encode("utf-8")).hexdigest()[:12]
+
+    def write(self, entry: dict):
+        line = json.dumps(entry, separators=(",", ":")) + "\n"
+        with self.lock:
+            if self.fd is None:
+                self.fd = os.open(
+                    self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600
+                )
+            # single write of a line in O_APPEND mode: workers don't interleave
+            os.write(self.fd, line.encode("utf-8"))
+
+    def before_request(self):
+        flask.g.trace_started = (time.time(), time.perf_counter())
+
+    def after_request(self, response: flask.Response) -> flask.Response:
+        started_on, started = flask.g.pop("trace_started", (None, None))
+        if started_on is None:
+            return response
+        request = flask.request
+        ip_addr = request.headers.getlist("X-Forwarded-For")
+        ip_addr = ip_addr[0] if ip_addr else request.remote_addr
+        try:
+            self.write(
+                {
+                    "t": round(started_on, 3),
+                    "d": round((time.perf_counter() - started) * 1000, 2),
+                    "m": request.method,
+                    "h": request.host,
+                    "p": request.path,
+                    "ua": platform_from_ua(request.user_agent.string) or "other",
+                    "c": self.client_id(ip_addr or ""),
+                    "s": response.status_code,
+                }
+            )
+        except Exception as exc:
+            logger.error(f"failed to record trace entry: {exc}")
+        return response
+
+
+def init_app(app: flask.Flask):
+    """record app's requests to Conf.trace_path"""
+    recorder = Recorder(Conf.trace_path, Conf.trace_salt or os.urandom(16).hex())
+    app.before_request(recorder.before_request)
+    app.after_request(recorder.after_request)
+    logger.info(f"recording requests trace to {Conf.trace_path}")
@@ -1,4 +1,3 @@
-import re
 from typing import Union
 
 import flask
@@ -7,8 +6,10 @@ from flask import Flask, Response, make_response, render_template, request
 from flask_babel import Babel
 from user_agents import parse
 
+from portal import trace
 from portal.constants import Conf
 from portal.database import User
+from portal.platforms import platform_from_ua
 from portal.platforms import success as platform_success
 
 
@@ -35,6 +36,8 @@ babel = Babel(
     default_timezone="UTC",
     locale_selector=get_locale,
 )
+if Conf.trace_path:
+    trace.init_app(app)
 get_identifier_for = Conf.get_filter_func("get_identifier_for")
 ack_client_registration = Conf.get_filter_func("ack_client_registration")
 
@@ -77,24 +80,11 @@ class Request:
     @property
     def parsed_ua(self):
         user_agent = parse(self.ua)
-        platform = None
+        platform = platform_from_ua(self.ua)
 
         def other_as_none(value):
             return None if value == "Other" else value
 
-        if re.search(r"Android", self.ua):
-            platform = "android"
-        if re.search(r"CaptiveNetworkSupport", self.ua):
-            platform = "apple"
-        if re.search(r"(OS X|iPhone OS|iPad OS)", self.ua):
-            platform = platform or "apple"
-        if re.search(r"(Microsoft NCSI)", self.ua):
-            platform = "windows"
-        if re.search(r"Windows", self.ua):
-            platform = platform or "windows"
-        if re.search(r"Linux", self.ua):
-            platform = "linux"
-
         return {
             "platform": platform or str(user_agent.os.family).lower(),
             "system": other_as_none(user_agent.os.family),
@@ -132,6 +122,11 @@ def entrypoint(u_path):
         user=user, action_required=action_required(user), **get_branding_context()
     )
 
+    if user.is_registered_elsewhere:
+        logger.debug(f"user registered on another node ({user.registered_on})")
+        if ack_client_registration(ip_addr=user.ip_addr):
+            user.take_over_registration()
+
     if user.is_registered and user.is_active:
         logger.debug(f"user IS registered ({user.registered_on})")
         return std_resp(
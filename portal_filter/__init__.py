@@ -24,7 +24,7 @@ import pathlib
 import platform
 import subprocess
 import time
-from typing import List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 
 if platform.system() != "Linux":
     raise NotImplementedError(f"{platform.system()} is not supported. Linux only")
@@ -38,6 +38,8 @@ except OSError as exc:
     time.sleep(5)
     import scapy.all
 
+from portal_filter.activity import ActivityTracker, Counters
+from portal_filter.leases import MAC_RE, LeaseIndex
 
 logging.basicConfig(level=logging.DEBUG if os.getenv("DEBUG") else logging.INFO)
 logger = logging.getLogger("portal-filter")
@@ -48,7 +50,32 @@ HTTPS_PORT: int = int(os.getenv("HTTP_PORT", "2443"))
 CAPTURED_NETWORKS: List[str] = os.getenv("CAPTURED_NETWORKS", "").split("|")
 CAPTURED_ADDRESS: str = os.getenv("CAPTURED_ADDRESS", "") or "198.51.100.1/32"
 
+DHCP_LEASES_FILE = pathlib.Path(
+    os.getenv("DHCP_LEASES_FILE", "/var/lib/misc/dnsmasq.leases")
+)
+IDENTITY_SOURCES: List[str] = os.getenv(
+    "IDENTITY_SOURCES", "leases|neighbors|arp"
+).split("|")
+
+PASSLIST_MODE: str = os.getenv("PASSLIST_MODE", "ip")
+PASSLIST_MACS_SET: str = "CAPTIVE_PASSLIST_MACS"
+DEFAULT_IDENTIFIER: str = "aa:bb:cc:dd:ee:ff"
+
+ACTIVITY_SOURCE: str = os.getenv("ACTIVITY_SOURCE", "conntrack")
+ACTIVITY_INTERVAL: int = int(os.getenv("ACTIVITY_INTERVAL", "30"))
+ACTIVITY_IDLE_AFTER: int = int(os.getenv("ACTIVITY_IDLE_AFTER", "600"))
+# empty to keep activity history in (each process') memory only
+ACTIVITY_STATE_FILE: str = os.getenv(
+    "ACTIVITY_STATE_FILE", "/var/run/portal-activity.json"
+)
+
+# seconds before giving up on a conntrack call
+CONNTRACK_TIMEOUT: float = float(os.getenv("CONNTRACK_TIMEOUT", "2"))
+
 INTERNET_STATUS_FILE = pathlib.Path("/var/run/internet")
+NEIGHBORS_FILE = pathlib.Path("/proc/net/arp")
+
+lease_index = LeaseIndex(DHCP_LEASES_FILE)
 
 ######################
 # portal-filter API: start
@@ -60,6 +87,12 @@ def initial_setup(**kwargs):
     result = query_netfilter("list chain nat CAPTIVE_PASSLIST")
     if not result.succeeded:
         return setup_capture(hotspot_ip=PORTAL_IP, captured_networks=CAPTURED_NETWORKS)
+    # already setup in ip mode: add MACs set and its rule
+    if (
+        PASSLIST_MODE == "mac"
+        and not query_netfilter(f"list set ip nat {PASSLIST_MACS_SET}").succeeded
+    ):
+        return query_netfilter_bulk(get_mac_passlist_rules(insert_at=2))
     return True, []
 
 
@@ -68,41 +101,102 @@ def ack_client_registration(ip_addr: str) -> bool:
     """whether ip_addr has been added to CAPTIVE_PASSLIST chain (if not present)
 
     rule is INSERTED so it's passed before the end-of-chain's RETURN
-    but AFTER the first two rules that allow CAPTURED_ADDRESS to work"""
+    but AFTER the first two rules that allow CAPTURED_ADDRESS to work
+
+    In mac PASSLIST_MODE, its identifier is added to PASSLIST_MACS_SET instead"""
 
     # check that it's not already present
     if ip_in_passlist(ip_addr):
         return False
 
-    result = query_netfilter(
-        f"insert rule ip nat CAPTIVE_PASSLIST index 2 ip saddr {ip_addr} "
-        + 'counter accept comment "allow host"'
-    )
+    if PASSLIST_MODE == "mac":
+        hw_addr = get_identifier_for(ip_addr)
+        if not is_valid_mac(hw_addr):
+            logger.error(f"cannot passlist {ip_addr}: unknown HW addr")
+            return False
+        return query_netfilter(
+            f"add element ip nat {PASSLIST_MACS_SET} {{ {hw_addr} }}"
+        ).succeeded
+
+    result = query_netfilter(get_allow_rule(ip_addr))
     return result.succeeded
 
 
 # API
-def get_identifier_for(ip_addr: str, default="aa:bb:cc:dd:ee:ff") -> str:
-    """return MAC address (using ARP) of (last) device set to ip_addr"""
+def get_identifier_for(ip_addr: str, default=DEFAULT_IDENTIFIER) -> str:
+    """return MAC address of (last) device set to ip_addr
+
+    IDENTITY_SOURCES are queried in order until one knows about ip_addr"""
     if not is_valid_ip(ip_addr):
         return default
 
-    try:
-        return scapy.all.getmacbyip(ip_addr) or default
-    except Exception as exc:
-        logger.debug(f"Failed to get HW addr for {ip_addr}: {exc}")
-        return default
+    for source in IDENTITY_SOURCES:
+        lookup = IDENTITY_LOOKUPS.get(source)
+        if lookup is None:
+            logger.error(f"unknown identity source: {source}")
+            continue
+        try:
+            hw_addr = lookup(ip_addr)
+        except Exception as exc:
+            logger.debug(f"Failed to get HW addr for {ip_addr} via {source}: {exc}")
+            continue
+        if hw_addr:
+            return hw_addr
+    return default
 
 
 # API
 def is_client_active(ip_addr: str) -> bool:
-    """whether one can consider this client active"""
+    """whether one can consider this client active
+
+    With counters ACTIVITY_SOURCE, clients without enough counters history yet
+    are checked via conntrack"""
     if not is_valid_ip(ip_addr):
         return False
 
+    if ACTIVITY_SOURCE == "counters":
+        active = activity_tracker.is_active(
+            get_identifier_for(ip_addr) if PASSLIST_MODE == "mac" else ip_addr
+        )
+        if active is not None:
+            return active
     return has_active_connection(ip_addr)
 
 
+# API
+def migrate_client(hw_addr: str, old_ip_addr: str, new_ip_addr: str) -> bool:
+    """whether hw_addr's passlist entry for old_ip_addr was moved to new_ip_addr
+
+    In ip PASSLIST_MODE, old_ip_addr's rule is replaced with one for new_ip_addr.
+    In mac PASSLIST_MODE, entries are keyed by MAC already so only a (former ip
+    mode) rule for old_ip_addr is replaced by hw_addr in PASSLIST_MACS_SET
+
+    Never migrates for an invalid or default hw_addr (client not identified) nor
+    if old_ip_addr is now another device's (lease reassigned): its rule is that
+    device's then"""
+    if not is_valid_mac(hw_addr):
+        return False
+    if not is_valid_ip(old_ip_addr) or not is_valid_ip(new_ip_addr):
+        return False
+
+    holder = get_identifier_for(old_ip_addr)
+    if is_valid_mac(holder) and holder.lower() != hw_addr.lower():
+        logger.debug(f"not migrating {hw_addr}: {old_ip_addr} now at {holder}")
+        return False
+
+    handle = get_rule_handle(old_ip_addr)
+    if not handle:
+        return False
+
+    commands = [f"delete rule ip nat CAPTIVE_PASSLIST handle {handle}"]
+    if PASSLIST_MODE == "mac":
+        commands.append(f"add element ip nat {PASSLIST_MACS_SET} {{ {hw_addr} }}")
+    elif not get_rule_handle(new_ip_addr):
+        commands.append(get_allow_rule(new_ip_addr))
+    logger.debug(f"migrating {hw_addr} passlist from {old_ip_addr} to {new_ip_addr}")
+    return query_netfilter_bulk(commands)[0]
+
+
 ######################
 
 
@@ -134,6 +228,13 @@ def is_valid_ip(ip_addr: str) -> bool:
     return True
 
 
+def is_valid_mac(hw_addr: str) -> bool:
+    """whether HW address string is a valid MAC (and not our default identifier)"""
+    return bool(
+        hw_addr and MAC_RE.match(hw_addr) and hw_addr.lower() != DEFAULT_IDENTIFIER
+    )
+
+
 def query_netfilter(command: str) -> NftResult:
     """Result of executing a netfilter command"""
     nft = nftables.Nftables()
@@ -154,8 +255,50 @@ def query_netfilter_bulk(commands: List[str]) -> Tuple[bool, List[NftResult]]:
     return all([res.succeeded for res in results]), results
 
 
+def get_allow_rule(ip_addr: str) -> str:
+    """command inserting ip_addr's accept rule in passlist"""
+    return (
+        f"insert rule ip nat CAPTIVE_PASSLIST index 2 ip saddr {ip_addr} "
+        + 'counter accept comment "allow host"'
+    )
+
+
+def get_mac_passlist_rules(insert_at: Optional[int] = None) -> List[str]:
+    """commands creating PASSLIST_MACS_SET and the rule accepting its members"""
+    rule = (
+        f"insert rule ip nat CAPTIVE_PASSLIST index {insert_at}"
+        if insert_at is not None
+        else "add rule ip nat CAPTIVE_PASSLIST"
+    )
+    return [
+        f"add set ip nat {PASSLIST_MACS_SET} {{ type ether_addr; counter; }}",
+        f"{rule} ether saddr @{PASSLIST_MACS_SET} "
+        + 'counter accept comment "allow hosts"',
+    ]
+
+
 def ip_in_passlist(ip_addr: str) -> str:
-    """whether ip_addr has its accept rule in our passlist"""
+    """whether ip_addr has its accept rule (or MAC, in mac mode) in our passlist"""
+    if not is_valid_ip(ip_addr):
+        return ""
+    if PASSLIST_MODE == "mac":
+        hw_addr = get_identifier_for(ip_addr)
+        if hw_addr_in_passlist(hw_addr):
+            return hw_addr
+    return get_rule_handle(ip_addr)
+
+
+def hw_addr_in_passlist(hw_addr: str) -> bool:
+    """whether hw_addr is in PASSLIST_MACS_SET"""
+    if not is_valid_mac(hw_addr):
+        return False
+    return query_netfilter(
+        f"get element ip nat {PASSLIST_MACS_SET} {{ {hw_addr} }}"
+    ).succeeded
+
+
+def get_rule_handle(ip_addr: str) -> str:
+    """handle of ip_addr's accept rule in our passlist, if any"""
     if not is_valid_ip(ip_addr):
         return ""
     result = query_netfilter("list chain nat CAPTIVE_PASSLIST")
@@ -239,6 +382,10 @@ def setup_capture(hotspot_ip: str, captured_networks: List[str]):
         + 'counter return comment "return derived addr to calling chain (captive_https)"'
     )
 
+    # registered hosts' MACs are in a set, accepted by a single rule
+    if PASSLIST_MODE == "mac":
+        rules += get_mac_passlist_rules()
+
     # registered host have an inserted rule in CAPTIVE_PASSLIST to ACCEPT based on IP
     # RETURN to calling chain at end of CAPTIVE_PASSLIST
     rules.append(
@@ -253,7 +400,8 @@ def has_active_connection(ip_addr: str) -> bool:
     r"""whether there is at least one established connection for this IP
 
     /!\ depends on `conntrack` binary being installed and will silently
-    report non-active if missing.
+    report non-active if missing. Raises subprocess.TimeoutExpired should it
+    not complete within CONNTRACK_TIMEOUT.
 
     /!\ active doesn't necessarily mean that the user behind the device is
     actively using the network. Most device nowadays (especially mobile)
@@ -279,10 +427,138 @@ def has_active_connection(ip_addr: str) -> bool:
         text=True,
         capture_output=True,
         check=False,
+        timeout=CONNTRACK_TIMEOUT,
     )
     return bool(ps.returncode == 0 and ps.stdout.strip())
 
 
+def get_passlist_counters() -> Optional[Counters]:
+    """packets and bytes counters of each IP in passlist (single nft query)"""
+    result = query_netfilter("list chain nat CAPTIVE_PASSLIST")
+    if not result.succeeded:
+        return None
+
+    counters = {}
+    for entry in result.json.get("nftables", []):
+        if entry.get("rule", {}).get("comment") != "allow host":
+            continue
+        expr = entry["rule"].get("expr", [{}])
+        ip = expr[0].get("match", {}).get("right")
+        counter = next((item["counter"] for item in expr if "counter" in item), None)
+        if not ip or not counter:
+            continue
+        counters[ip] = (counter.get("packets", 0), counter.get("bytes", 0))
+
+    # MACs set elements, keyed by MAC
+    if PASSLIST_MODE == "mac":
+        elements = get_passlist_elements()
+        if elements is None:
+            return None
+        counters.update(elements)
+    return counters
+
+
+def get_passlist_elements() -> Optional[Counters]:
+    """packets and bytes counters of each MAC in PASSLIST_MACS_SET"""
+    result = query_netfilter(f"list set ip nat {PASSLIST_MACS_SET}")
+    if not result.succeeded:
+        return None
+
+    elements = {}
+    for entry in result.json.get("nftables", []):
+        for elem in entry.get("set", {}).get("elem", []):
+            # plain value or {"elem": {"val": …, "counter": {…}}} with counters
+            if isinstance(elem, str):
+                elements[elem] = (0, 0)
+                continue
+            value = elem.get("elem", {})
+            counter = value.get("counter", {})
+            elements[value.get("val")] = (
+                counter.get("packets", 0),
+                counter.get("bytes", 0),
+            )
+    return elements
+
+
+activity_tracker = ActivityTracker(
+    snapshot=get_passlist_counters,
+    interval=ACTIVITY_INTERVAL,
+    idle_after=ACTIVITY_IDLE_AFTER,
+    state_path=pathlib.Path(ACTIVITY_STATE_FILE) if ACTIVITY_STATE_FILE else None,
+)
+
+
+def get_mac_from_leases(ip_addr: str) -> Optional[str]:
+    """MAC address of the device ip_addr is leased to (dnsmasq leases index)"""
+    return lease_index.get(ip_addr)
+
+
+def get_neighbors() -> Dict[str, str]:
+    """IP to MAC mapping of complete entries in kernel's neighbor (ARP) table"""
+    neighbors = {}
+    # IP address  HW type  Flags  HW address  Mask  Device
+    for line in NEIGHBORS_FILE.read_text().splitlines()[1:]:
+        parts = line.split()
+        if len(parts) >= 4 and parts[2] != "0x0":
+            neighbors[parts[0]] = parts[3]
+    return neighbors
+
+
+def get_mac_from_neighbors(ip_addr: str) -> Optional[str]:
+    """MAC address of ip_addr in kernel's neighbor (ARP) table, if complete"""
+    return get_neighbors().get(ip_addr)
+
+
+def get_mac_from_arp(ip_addr: str) -> Optional[str]:
+    """MAC address of ip_addr as found by scapy (ARP request if not cached)"""
+    return scapy.all.getmacbyip(ip_addr)
+
+
+IDENTITY_LOOKUPS = {
+    "leases": get_mac_from_leases,
+    "neighbors": get_mac_from_neighbors,
+    "arp": get_mac_from_arp,
+}
+
+
+def get_neighbors_or_empty() -> Dict[str, str]:
+    """get_neighbors, empty should neighbors table not be readable"""
+    try:
+        return get_neighbors()
+    except Exception as exc:
+        logger.debug(f"Failed to read neighbors table: {exc}")
+        return {}
+
+
+def get_addresses_for(
+    hw_addr: str, neighbors: Optional[Dict[str, str]] = None
+) -> List[str]:
+    """IP addresses known (leases, neighbors table) for hw_addr
+
+    neighbors (from get_neighbors) is read if not passed. Pass it when looking up
+    several MACs so the neighbors table is read only once"""
+    addresses = set()
+    if "leases" in IDENTITY_SOURCES:
+        addresses.update(lease_index.addresses_of(hw_addr))
+    if neighbors is None:
+        neighbors = get_neighbors_or_empty()
+    addresses.update(
+        ip_addr for ip_addr, mac in neighbors.items() if mac.lower() == hw_addr.lower()
+    )
+    return sorted(addresses)
+
+
+def is_hw_addr_active(hw_addr: str, neighbors: Optional[Dict[str, str]] = None) -> bool:
+    """whether this MAC-passlisted client can be considered active"""
+    if ACTIVITY_SOURCE == "counters":
+        active = activity_tracker.is_active(hw_addr)
+        if active is not None:
+            return active
+    return any(
+        has_active_connection(ip) for ip in get_addresses_for(hw_addr, neighbors)
+    )
+
+
 def clear_passlist(inactives_only: Optional[bool] = True):
     """remove all registered IPs from CAPTIVE_PASSLIST chain or innactives only"""
 
@@ -301,8 +577,16 @@ def clear_passlist(inactives_only: Optional[bool] = True):
             continue
 
         rule = f"delete rule ip nat CAPTIVE_PASSLIST handle {handle}"
-        if not inactives_only or not has_active_connection(ip):
+        if not inactives_only or not is_client_active(ip):
             rules.append(rule)
+
+    if PASSLIST_MODE == "mac":
+        # read once for all MACs
+        neighbors = get_neighbors_or_empty() if inactives_only else {}
+        for hw_addr in get_passlist_elements() or {}:
+            rule = f"delete element ip nat {PASSLIST_MACS_SET} {{ {hw_addr} }}"
+            if not inactives_only or not is_hw_addr_active(hw_addr, neighbors):
+                rules.append(rule)
     if rules:
         return query_netfilter_bulk(rules)
     return True, []
@@ -313,7 +597,14 @@ def remove_from_passlist(ip_addr: str) -> bool:
     if not is_valid_ip(ip_addr):
         return False
 
-    handle = ip_in_passlist(ip_addr)
+    if PASSLIST_MODE == "mac":
+        hw_addr = get_identifier_for(ip_addr)
+        if hw_addr_in_passlist(hw_addr):
+            return query_netfilter(
+                f"delete element ip nat {PASSLIST_MACS_SET} {{ {hw_addr} }}"
+            ).succeeded
+
+    handle = get_rule_handle(ip_addr)
     if not handle:
         return False
 
@@ -0,0 +1,175 @@
+r"""Counter-based client activity detection
+
+Every passlist rule has a counter so a single listing of CAPTIVE_PASSLIST returns
+packets and bytes counts for all registered clients at once. Snapshotting those
+counters (at most once per interval) and comparing them with the previous snapshot
+tells which clients generated traffic since. Clients without any change for
+idle_after seconds are considered idle.
+
+Snapshots, and when each client was first seen and last active, are kept in a
+state file so the web workers and the periodic clean-up (separate processes,
+the latter short-lived) share the same history and interval.
+
+A client without enough history (first seen less than idle_after ago and no
+change since) is neither active nor idle: is_active() returns None and callers
+are expected to check it another way.
+
+/!\ CAPTIVE_PASSLIST is in the nat table, which only sees the first packet of each
+connection: counters thus increase with new HTTP(s) connections, not volume.
+"""
+
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import pathlib
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger("portal-filter")
+
+# IP to (packets, bytes) of its passlist rule
+Counters = Dict[str, Tuple[int, int]]
+
+
+class ActivityTracker:
+    """per-IP activity from periodic snapshots of passlist counters
+
+    snapshot is expected to return None should counters not be retrievable,
+    in which case previous state is kept.
+
+    Without state_path, history is kept in memory only."""
+
+    def __init__(
+        self,
+        snapshot: Callable[[], Optional[Counters]],
+        interval: float,
+        idle_after: float,
+        state_path: Optional[pathlib.Path] = None,
+    ):
+        self.snapshot = snapshot
+        self.interval = interval
+        self.idle_after = idle_after
+        self.state_path = state_path
+        self.counters: Counters = {}
+        self.first_seen_on: Dict[str, float] = {}
+        self.last_active_on: Dict[str, float] = {}
+        self.refreshed_on: Optional[float] = None
+        self._loaded_mtime: Optional[int] = None
+        self._lock = threading.Lock()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def locked(self):
+        """exclusive access to state, across threads and processes"""
+        with self._lock:
+            if self.state_path is None:
+                yield
+                return
+            try:
+                fd = os.open(
+                    self.state_path.with_name(f"{self.state_path.name}.lock"),
+                    os.O_RDWR | os.O_CREAT,
+                    0o600,
+                )
+            except OSError as exc:
+                logger.warning(f"cannot lock activity state: {exc}")
+                yield
+                return
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                yield
+            finally:
+                os.close(fd)
+
+    def load(self):
+        """replace state with state file's, if changed since last load"""
+        if self.state_path is None:
+            return
+        try:
+            mtime = self.state_path.stat().st_mtime_ns
+            if mtime == self._loaded_mtime:
+                return
+            state = json.loads(self.state_path.read_text())
+        except FileNotFoundError:
+            return
+        except Exception as exc:
+            logger.warning(f"cannot load activity state from {self.state_path}: {exc}")
+            return
+        self.counters = {
+            key: (values[0], values[1])
+            for key, values in state.get("counters", {}).items()
+        }
+        self.first_seen_on = state.get("first_seen_on", {})
+        self.last_active_on = state.get("last_active_on", {})
+        self.refreshed_on = state.get("refreshed_on")
+        self._loaded_mtime = mtime
+
+    def save(self):
+        """write state to state file (atomically)"""
+        if self.state_path is None:
+            return
+        tmp_path = self.state_path.with_name(f"{self.state_path.name}.tmp")
+        try:
+            tmp_path.write_text(
+                json.dumps(
+                    {
+                        "refreshed_on": self.refreshed_on,
+                        "counters": self.counters,
+                        "first_seen_on": self.first_seen_on,
+                        "last_active_on": self.last_active_on,
+                    }
+                )
+            )
+            os.replace(tmp_path, self.state_path)
+            self._loaded_mtime = self.state_path.stat().st_mtime_ns
+        except Exception as exc:
+            logger.warning(f"cannot save activity state to {self.state_path}: {exc}")
+
+    def refresh(self, force: Optional[bool] = False):
+        """update state from a new snapshot if last one is older than interval"""
+        with self.locked():
+            self.load()
+            now = time.time()
+            if (
+                not force
+                and self.refreshed_on is not None
+                and 0 <= now - self.refreshed_on < self.interval
+            ):
+                return
+            self.refreshed_on = now
+
+            counters = self.snapshot()
+            if counters is not None:
+                for key, values in counters.items():
+                    previous = self.counters.get(key)
+                    if previous is None:
+                        self.first_seen_on[key] = now
+                    # reset counters (rule re-created) are a change as well
+                    elif previous != values:
+                        self.last_active_on[key] = now
+                for history in (self.first_seen_on, self.last_active_on):
+                    for key in [key for key in history if key not in counters]:
+                        del history[key]
+                self.counters = counters
+            self.save()
+
+    def is_active(self, key: str) -> Optional[bool]:
+        """whether key's counters changed within the last idle_after seconds
+
+        None if unknown: not in passlist or no change since first seen, less
+        than idle_after seconds ago"""
+        self.refresh()
+        now = time.time()
+        last_active_on = self.last_active_on.get(key)
+        if last_active_on is not None:
+            return now - last_active_on < self.idle_after
+        first_seen_on = self.first_seen_on.get(key)
+        if first_seen_on is None or now - first_seen_on < self.idle_after:
+            return None
+        return False
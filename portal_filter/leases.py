@@ -0,0 +1,205 @@
+"""DHCP-lease-backed IP to MAC index
+
+dnsmasq keeps the list of leases it handed out in a lease file, mapping every
+IP to the MAC of the device it was leased to. Parsing it into a dict allows
+answering identity requests without sending ARP requests (nor any syscall),
+including for clients that don't answer ARP (sleeping phones for instance).
+
+The file is watched (inotify) from a background thread and the index is updated
+in-place whenever dnsmasq rewrites it.
+
+dnsmasq lease file format (one lease per line, IPv6 ones following a `duid` line):
+    <expiry> <mac> <ip> <hostname|*> <client-id|*>
+"""
+
+import ctypes
+import ipaddress
+import logging
+import os
+import pathlib
+import re
+import select
+import struct
+import threading
+import time
+from typing import Dict, List, Optional, Set
+
+logger = logging.getLogger("portal-filter")
+
+MAC_RE = re.compile(r"^([0-9a-f]{2}:){5}[0-9a-f]{2}$", re.IGNORECASE)
+
+# inotify(7) event masks we're interested in (on the parent directory)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_CHANGES = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+# struct inotify_event { int wd; uint32_t mask; uint32_t cookie; uint32_t len; }
+EVENT_HEADER = struct.Struct("iIII")
+
+# seconds to wait for subsequent events before reloading (dnsmasq truncates then
+# writes the file so a single update triggers several events)
+COALESCE_DELAY: float = 0.1
+# seconds between checks of file's mtime should inotify not be available
+POLL_INTERVAL: float = 5
+
+
+def parse_leases(text: str) -> Dict[str, str]:
+    """IPv4 to MAC mapping of the leases in a dnsmasq lease file's content"""
+    entries = {}
+    for line in text.splitlines():
+        parts = line.split()
+        if len(parts) < 3 or parts[0] == "duid":
+            continue
+        hw_addr, ip_addr = parts[1:3]
+        # IPv6 leases use IAID instead of MAC, non-ethernet ones a prefixed HW addr
+        if not MAC_RE.match(hw_addr):
+            continue
+        try:
+            ipaddress.IPv4Address(ip_addr)
+        except Exception:
+            continue
+        entries[ip_addr] = hw_addr.lower()
+    return entries
+
+
+class InotifyWatcher:
+    """minimal ctypes-based inotify watcher on a single directory"""
+
+    def __init__(self, directory: pathlib.Path, mask: int = IN_CHANGES):
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            inotify_init1 = libc.inotify_init1
+            inotify_add_watch = libc.inotify_add_watch
+        except AttributeError as exc:
+            raise OSError(f"inotify not supported: {exc}") from exc
+
+        self.fd = inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        if inotify_add_watch(self.fd, str(directory).encode("utf-8"), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, os.strerror(errno), str(directory))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        os.close(self.fd)
+
+    @staticmethod
+    def parse_names(data: bytes) -> Set[str]:
+        """names of the files referenced in a buffer of inotify events"""
+        names = set()
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            _, _, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            names.add(data[offset : offset + length].rstrip(b"\0").decode("utf-8"))
+            offset += length
+        return names
+
+    def read_names(self, coalesce: float = COALESCE_DELAY) -> Set[str]:
+        """names of changed files, blocking until at least one event is received
+
+        Events received within coalesce seconds of each other are merged"""
+        names = self.parse_names(os.read(self.fd, 4096))
+        while select.select([self.fd], [], [], coalesce)[0]:
+            names |= self.parse_names(os.read(self.fd, 4096))
+        return names
+
+
+class LeaseIndex:
+    """in-memory IP to MAC index of a dnsmasq lease file
+
+    Watcher thread is started on first lookup (and again after a fork as threads
+    don't survive it) so it works with both pre-forking and lazy uwsgi setups."""
+
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        self.entries: Dict[str, str] = {}
+        self._started = False
+        self._lock = threading.Lock()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._started = False
+        self._lock = threading.Lock()
+
+    def get(self, ip_addr: str, default: Optional[str] = None) -> Optional[str]:
+        """MAC address leased to ip_addr"""
+        if not self._started:
+            self.start()
+        return self.entries.get(ip_addr, default)
+
+    def addresses_of(self, hw_addr: str) -> List[str]:
+        """IP addresses leased to hw_addr"""
+        if not self._started:
+            self.start()
+        hw_addr = hw_addr.lower()
+        return [ip for ip, mac in list(self.entries.items()) if mac == hw_addr]
+
+    def start(self):
+        """load leases and start watching for changes (if not already)"""
+        with self._lock:
+            if self._started:
+                return
+            # watch before loading so no change gets lost in between
+            try:
+                watcher = InotifyWatcher(self.path.parent)
+            except OSError as exc:
+                logger.warning(f"cannot watch {self.path} ({exc}), polling instead")
+                watcher = None
+            self.reload()
+            threading.Thread(
+                target=self._watch, args=(watcher,), name="leases-watcher", daemon=True
+            ).start()
+            self._started = True
+
+    def reload(self):
+        """update index in-place from the lease file's content"""
+        try:
+            text = self.path.read_text()
+        except FileNotFoundError:
+            # dnsmasq has not written it (yet)
+            text = ""
+        except Exception as exc:
+            logger.error(f"cannot read leases from {self.path}: {exc}")
+            return
+
+        entries = parse_leases(text)
+        for ip_addr in [ip_addr for ip_addr in self.entries if ip_addr not in entries]:
+            self.entries.pop(ip_addr, None)
+        for ip_addr, hw_addr in entries.items():
+            if self.entries.get(ip_addr) != hw_addr:
+                self.entries[ip_addr] = hw_addr
+        logger.debug(f"loaded {len(self.entries)} leases from {self.path}")
+
+    def _watch(self, watcher: Optional[InotifyWatcher]):
+        if watcher is None:
+            return self._poll()
+
+        with watcher:
+            while True:
+                try:
+                    if self.path.name in watcher.read_names():
+                        self.reload()
+                except Exception as exc:
+                    logger.error(f"failed to process leases change: {exc}")
+                    time.sleep(POLL_INTERVAL)
+
+    def _poll(self):
+        mtime = None
+        while True:
+            try:
+                current = self.path.stat().st_mtime_ns
+            except OSError:
+                current = None
+            if current != mtime:
+                mtime = current
+                self.reload()
+            time.sleep(POLL_INTERVAL)
@@ -0,0 +1,56 @@
+"""test setup: run against the benchmarks' stand-ins, never the host's netfilter
+
+- `nftables` is the in-memory fake_nftables (reset for each test)
+- portal uses the dummy filter module and the memory users backend
+- portal_filter keeps activity history in memory (no ACTIVITY_STATE_FILE)
+"""
+
+import os
+import pathlib
+import sys
+
+import pytest
+
+ROOT = pathlib.Path(__file__).parent.parent.resolve()
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT.joinpath("benchmarks")))
+
+import fake_nftables  # noqa: E402
+
+sys.modules["nftables"] = fake_nftables
+
+# before portal.constants reads them
+os.environ.setdefault("BACKEND", "memory")
+os.environ.setdefault("FILTER_MODULE", "dummy_portal_filter")
+# before portal_filter reads it: never the host's activity state
+os.environ["ACTIVITY_STATE_FILE"] = ""
+
+
+@pytest.fixture
+def nft_table():
+    """fresh stand-in nat table (as left by setup_capture)"""
+    fake_nftables.table = fake_nftables.Table()
+    return fake_nftables.table
+
+
+@pytest.fixture
+def leases(monkeypatch, tmp_path):
+    """portal_filter identifying clients from a dnsmasq leases file only
+
+    Returns a function replacing leases with an {ip_addr: hw_addr} mapping"""
+    import portal_filter
+    from portal_filter.leases import LeaseIndex
+
+    index = LeaseIndex(tmp_path / "dnsmasq.leases")
+    monkeypatch.setattr(portal_filter, "lease_index", index)
+    monkeypatch.setattr(portal_filter, "IDENTITY_SOURCES", ["leases"])
+    monkeypatch.setattr(portal_filter, "get_neighbors", lambda: {})
+
+    def set_leases(leased: dict):
+        index.path.write_text(
+            "".join(f"1700000000 {mac} {ip} * *\n" for ip, mac in leased.items())
+        )
+        index.reload()
+
+    set_leases({})
+    return set_leases
@@ -0,0 +1,190 @@
+import pytest
+
+import portal_filter
+from portal_filter import activity
+from portal_filter.activity import ActivityTracker
+
+INTERVAL = 30
+IDLE_AFTER = 600
+
+
+class Clock:
+    def __init__(self, now: float = 1_700_000_000.0):
+        self.now = now
+
+    def time(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(activity, "time", clock)
+    return clock
+
+
+class Snapshots:
+    def __init__(self, counters):
+        self.counters = counters
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return None if self.counters is None else dict(self.counters)
+
+
+def get_tracker(snapshot, state_path=None) -> ActivityTracker:
+    return ActivityTracker(
+        snapshot=snapshot,
+        interval=INTERVAL,
+        idle_after=IDLE_AFTER,
+        state_path=state_path,
+    )
+
+
+def test_new_rules_are_unknown_then_idle(clock):
+    snapshot = Snapshots({"10.0.0.1": (3, 192), "10.0.0.2": (3, 192)})
+    tracker = get_tracker(snapshot)
+    assert tracker.is_active("10.0.0.1") is None
+    assert tracker.is_active("10.0.0.3") is None
+
+    clock.now += INTERVAL
+    snapshot.counters["10.0.0.2"] = (4, 256)
+    assert tracker.is_active("10.0.0.1") is None
+    assert tracker.is_active("10.0.0.2") is True
+
+    clock.now += IDLE_AFTER
+    assert tracker.is_active("10.0.0.1") is False
+    assert tracker.is_active("10.0.0.2") is False
+
+
+def test_refresh_once_per_interval(clock):
+    snapshot = Snapshots({"10.0.0.1": (3, 192)})
+    tracker = get_tracker(snapshot)
+    for _ in range(3):
+        tracker.is_active("10.0.0.1")
+    assert snapshot.calls == 1
+
+    clock.now += INTERVAL - 1
+    tracker.refresh()
+    assert snapshot.calls == 1
+    tracker.refresh(force=True)
+    assert snapshot.calls == 2
+
+    # clock going backward doesn't prevent refreshes
+    clock.now -= 3600
+    tracker.refresh()
+    assert snapshot.calls == 3
+
+
+def test_failed_snapshot_keeps_state(clock):
+    snapshot = Snapshots({"10.0.0.1": (3, 192)})
+    tracker = get_tracker(snapshot)
+    tracker.refresh()
+    clock.now += INTERVAL
+    snapshot.counters = {"10.0.0.1": (5, 320)}
+    assert tracker.is_active("10.0.0.1") is True
+
+    clock.now += INTERVAL
+    snapshot.counters = None
+    assert tracker.is_active("10.0.0.1") is True
+    assert tracker.counters == {"10.0.0.1": (5, 320)}
+
+
+def test_removed_rules_are_forgotten(clock):
+    snapshot = Snapshots({"10.0.0.1": (3, 192)})
+    tracker = get_tracker(snapshot)
+    tracker.refresh()
+    clock.now += INTERVAL
+    snapshot.counters = {}
+    tracker.refresh()
+    assert tracker.first_seen_on == {}
+    assert tracker.last_active_on == {}
+
+    # a re-created rule starts a new history
+    clock.now += IDLE_AFTER
+    snapshot.counters = {"10.0.0.1": (0, 0)}
+    assert tracker.is_active("10.0.0.1") is None
+
+
+def test_state_shared_between_processes(clock, tmp_path):
+    state_path = tmp_path / "activity.json"
+    snapshot = Snapshots({"10.0.0.1": (3, 192), "10.0.0.2": (3, 192)})
+    get_tracker(snapshot, state_path).refresh()
+    assert snapshot.calls == 1
+
+    # within interval: another process uses the saved snapshot
+    clock.now += INTERVAL - 1
+    other = get_tracker(snapshot, state_path)
+    assert other.is_active("10.0.0.1") is None
+    assert snapshot.calls == 1
+
+    clock.now += 1
+    snapshot.counters["10.0.0.2"] = (9, 576)
+    assert get_tracker(snapshot, state_path).is_active("10.0.0.2") is True
+
+    clock.now += IDLE_AFTER
+    tracker = get_tracker(snapshot, state_path)
+    assert tracker.is_active("10.0.0.1") is False
+    assert tracker.counters == {"10.0.0.1": (3, 192), "10.0.0.2": (9, 576)}
+
+
+def test_unwritable_state_is_kept_in_memory(clock, tmp_path):
+    snapshot = Snapshots({"10.0.0.1": (3, 192)})
+    tracker = get_tracker(snapshot, tmp_path / "missing" / "activity.json")
+    clock.now += INTERVAL
+    assert tracker.is_active("10.0.0.1") is None
+    clock.now += IDLE_AFTER
+    assert tracker.is_active("10.0.0.1") is False
+
+
+def test_periodic_cleanup_removes_idle_clients(monkeypatch, clock, tmp_path, nft_table):
+    clients = [f"10.0.0.{index}" for index in range(10, 15)]
+    for ip_addr in clients:
+        nft_table.allow(ip_addr)
+    monkeypatch.setattr(portal_filter, "ACTIVITY_SOURCE", "counters")
+    # all have an ESTABLISHED connection (phoning home)
+    monkeypatch.setattr(portal_filter, "has_active_connection", lambda ip_addr: True)
+
+    def cleanup():
+        # each clean-up is a new process
+        monkeypatch.setattr(
+            portal_filter,
+            "activity_tracker",
+            get_tracker(portal_filter.get_passlist_counters, tmp_path / "state.json"),
+        )
+        portal_filter.clear_passlist()
+        return [
+            ip_addr for ip_addr in clients if portal_filter.get_rule_handle(ip_addr)
+        ]
+
+    # no history: conntrack decides
+    assert cleanup() == clients
+
+    # new connection from one of them
+    clock.now += IDLE_AFTER / 2
+    for entry in nft_table.chains["CAPTIVE_PASSLIST"]:
+        if entry["rule"]["expr"][0]["match"]["right"] == clients[2]:
+            entry["rule"]["expr"][1]["counter"]["packets"] += 1
+    assert cleanup() == clients
+
+    clock.now += IDLE_AFTER / 2 + 1
+    assert cleanup() == [clients[2]]
+
+    clock.now += IDLE_AFTER
+    assert cleanup() == []
+
+
+def test_one_shot_cleanup_without_history(monkeypatch, clock, tmp_path, nft_table):
+    clients = [f"10.0.0.{index}" for index in range(10, 15)]
+    for ip_addr in clients:
+        nft_table.allow(ip_addr)
+    monkeypatch.setattr(portal_filter, "ACTIVITY_SOURCE", "counters")
+    monkeypatch.setattr(portal_filter, "has_active_connection", lambda ip_addr: False)
+    monkeypatch.setattr(
+        portal_filter,
+        "activity_tracker",
+        get_tracker(portal_filter.get_passlist_counters, tmp_path / "state.json"),
+    )
+    portal_filter.clear_passlist()
+    assert not any(portal_filter.get_rule_handle(ip_addr) for ip_addr in clients)
@@ -0,0 +1,225 @@
+import datetime
+import time
+
+import fake_kv_server
+import pytest
+
+from portal import database, web
+from portal.backends import KVBackend, MemoryBackend, SqliteBackend
+from portal.constants import DEFAULT_IDENTIFIER, Conf
+from portal.database import User
+
+
+@pytest.fixture
+def kv_server():
+    server = fake_kv_server.serve()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def wait_for(predicate, timeout: float = 5) -> bool:
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def get_kv_backend(server, cache_ttl: float = 60) -> KVBackend:
+    host, port = server.server_address
+    backend = KVBackend(f"redis://{host}:{port}/0", cache_ttl=cache_ttl)
+    backend.listen()
+    # whole cache is invalidated once subscribed
+    assert wait_for(lambda: backend.generation)
+    return backend
+
+
+def get_record(hw_addr: str, **values):
+    return {
+        "hw_addr": hw_addr,
+        "ip_addr": "192.168.2.10",
+        "last_seen_on": datetime.datetime(2025, 1, 1, 12, 0),
+        "registered_on": None,
+        **values,
+    }
+
+
+@pytest.mark.parametrize("name", ["memory", "sqlite", "kv"])
+def test_roundtrip(name, tmp_path, kv_server):
+    backend = {
+        "memory": MemoryBackend,
+        "sqlite": lambda: SqliteBackend(tmp_path / "users.db"),
+        "kv": lambda: get_kv_backend(kv_server),
+    }[name]()
+    record = get_record(
+        "aa:bb:cc:00:00:01", registered_on=datetime.datetime(2025, 1, 1, 12, 1)
+    )
+    backend.put(record)
+    # sqlite returns all its columns
+    stored = backend.get("aa:bb:cc:00:00:01")
+    assert {key: stored[key] for key in record} == record
+    assert backend.get("aa:bb:cc:00:00:02") is None
+
+    backend.put_many([get_record("aa:bb:cc:00:00:02"), get_record("aa:bb:cc:00:00:03")])
+    assert sorted(
+        backend.get_many(["aa:bb:cc:00:00:02", "aa:bb:cc:00:00:03", "missing"])
+    ) == ["aa:bb:cc:00:00:02", "aa:bb:cc:00:00:03"]
+
+
+def test_sqlite_ignores_shared_only_fields(tmp_path):
+    backend = SqliteBackend(tmp_path / "users.db")
+    backend.put(get_record("aa:bb:cc:00:00:01", registered_by="node-a"))
+    assert "registered_by" not in backend.get("aa:bb:cc:00:00:01")
+
+
+def test_kv_reads_are_cached_and_batched(kv_server):
+    backend = get_kv_backend(kv_server)
+    other_node = get_kv_backend(kv_server)
+    other_node.put_many([get_record(f"aa:bb:cc:00:00:0{index}") for index in range(4)])
+    commands = kv_server.store.commands
+
+    backend.get_many([f"aa:bb:cc:00:00:0{index}" for index in range(4)] + ["missing"])
+    assert commands["MGET"] == 1
+    # present and missing ones are cached
+    backend.get("aa:bb:cc:00:00:01")
+    backend.get("missing")
+    assert commands["MGET"] == 1
+
+    # own writes update the cache
+    backend.put(get_record("aa:bb:cc:00:00:01", ip_addr="192.168.2.99"))
+    assert backend.get("aa:bb:cc:00:00:01")["ip_addr"] == "192.168.2.99"
+    assert commands["MGET"] == 1
+
+
+def test_kv_cache_expires(kv_server):
+    backend = get_kv_backend(kv_server, cache_ttl=0)
+    other_node = get_kv_backend(kv_server)
+    assert backend.get("aa:bb:cc:00:00:01") is None
+    other_node.put(get_record("aa:bb:cc:00:00:01"))
+    assert backend.get("aa:bb:cc:00:00:01") is not None
+
+
+@pytest.fixture
+def shared_backend(monkeypatch, kv_server):
+    backend = get_kv_backend(kv_server)
+    monkeypatch.setattr(database, "backend", backend)
+    monkeypatch.setattr(database, "ip_in_passlist", lambda ip_addr: False)
+    return backend
+
+
+def test_registered_elsewhere(shared_backend):
+    user = User(hw_addr="aa:bb:cc:00:00:01", ip_addr="192.168.2.10")
+    user.register()
+    assert user.registered_by == Conf.node_name
+    # registered here, not in passlist anymore (cleared as inactive)
+    assert not User.get(user.hw_addr).is_registered_elsewhere
+
+    user.registered_by = "other-node"
+    user.save()
+    assert User.get(user.hw_addr).is_registered_elsewhere
+
+    # expired registration
+    user.registered_on -= datetime.timedelta(seconds=Conf.timeout + 1)
+    user.save()
+    assert not User.get(user.hw_addr).is_registered_elsewhere
+
+    # unknown origin
+    user.register()
+    user.registered_by = None
+    user.save()
+    assert not User.get(user.hw_addr).is_registered_elsewhere
+
+
+def test_unidentified_clients_not_registered_elsewhere(shared_backend):
+    # unidentified client registered on another node
+    user = User.create_or_update(DEFAULT_IDENTIFIER, "10.1.0.10", {})
+    user.register()
+    user.registered_by = "other-node"
+    user.save()
+
+    other = User.create_or_update(DEFAULT_IDENTIFIER, "10.1.0.99", {})
+    assert other.registration_is_valid
+    assert not other.is_registered_elsewhere
+
+
+@pytest.fixture
+def web_client(monkeypatch, shared_backend):
+    """portal app with a stand-in passlist (set of IPs) and active clients"""
+    passlist = set()
+
+    def ack_client_registration(ip_addr):
+        if ip_addr in passlist:
+            return False
+        passlist.add(ip_addr)
+        return True
+
+    monkeypatch.setattr(database, "ip_in_passlist", lambda ip_addr: ip_addr in passlist)
+    monkeypatch.setattr(database, "is_client_active", lambda ip_addr: True)
+    monkeypatch.setattr(web, "ack_client_registration", ack_client_registration)
+    monkeypatch.setattr(web, "get_identifier_for", lambda ip_addr: "aa:bb:cc:00:00:01")
+    return web.app.test_client(), passlist
+
+
+def test_registration_taken_over_once_passlisted(web_client):
+    client, passlist = web_client
+    user = User.create_or_update("aa:bb:cc:00:00:01", "192.168.2.10", {})
+    user.register()
+    user.registered_by = "other-node"
+    user.save()
+
+    headers = {"X-Forwarded-For": "192.168.2.10"}
+    client.get("/", headers=headers)
+    assert passlist == {"192.168.2.10"}
+    assert User.get(user.hw_addr).registered_by == Conf.node_name
+
+    # cleared as inactive by our clean-up: goes through the portal again
+    passlist.clear()
+    client.get("/", headers=headers)
+    assert passlist == set()
+
+
+def test_not_registered_elsewhere_with_local_backend(monkeypatch):
+    monkeypatch.setattr(database, "backend", MemoryBackend())
+    monkeypatch.setattr(database, "ip_in_passlist", lambda ip_addr: False)
+    user = User(hw_addr="aa:bb:cc:00:00:01", ip_addr="192.168.2.10")
+    user.register()
+    user.registered_by = "other-node"
+    assert not user.is_registered_elsewhere
+
+
+def test_kv_invalidations(kv_server):
+    backend = get_kv_backend(kv_server)
+    other_node = get_kv_backend(kv_server)
+    assert backend.get("aa:bb:cc:00:00:01") is None
+
+    other_node.put(get_record("aa:bb:cc:00:00:01"))
+    assert wait_for(lambda: backend.get("aa:bb:cc:00:00:01") is not None)
+
+    other_node.put(get_record("aa:bb:cc:00:00:01", ip_addr="192.168.2.99"))
+    assert wait_for(
+        lambda: backend.get("aa:bb:cc:00:00:01")["ip_addr"] == "192.168.2.99"
+    )
+
+    # own writes don't invalidate own cache
+    reads = kv_server.store.commands["MGET"]
+    backend.put(get_record("aa:bb:cc:00:00:01", ip_addr="192.168.2.10"))
+    time.sleep(0.1)
+    assert backend.get("aa:bb:cc:00:00:01")["ip_addr"] == "192.168.2.10"
+    assert kv_server.store.commands["MGET"] == reads
+
+
+def test_kv_invalidation_racing_read_is_not_cached(kv_server, monkeypatch):
+    backend = get_kv_backend(kv_server)
+    mget = backend.client.mget
+
+    def racing_mget(keys):
+        values = mget(keys)
+        # invalidation received while reading
+        backend.invalidate(["aa:bb:cc:00:00:01"])
+        return values
+
+    monkeypatch.setattr(backend.client, "mget", racing_mget)
+    backend.get("aa:bb:cc:00:00:01")
+    assert "aa:bb:cc:00:00:01" not in backend.cache
@@ -0,0 +1,224 @@
+import concurrent.futures
+import os
+import subprocess
+import threading
+import time
+
+import pytest
+
+import portal_filter
+from portal import shared_table
+from portal.breakers import CircuitBreaker
+from portal.constants import DEFAULT_IDENTIFIER, Conf
+
+
+class Filter:
+    """filter function stand-in, failing, hanging or answering on demand"""
+
+    def __init__(self):
+        self.calls = 0
+        self.error = None
+        self.delay = 0.0
+        self.release = threading.Event()
+        self.release.set()
+
+    def __call__(self, ip_addr: str, **kwargs):
+        self.calls += 1
+        self.release.wait()
+        if self.delay:
+            time.sleep(self.delay)
+        if self.error:
+            raise self.error
+        return f"02:00:00:00:00:{ip_addr.rsplit('.', 1)[1].zfill(2)}"
+
+
+def get_breaker(func, name: str = "get_identifier_for", **kwargs) -> CircuitBreaker:
+    params = {"timeout": 0.1, "threshold": 2, "reset_after": 0.2, **kwargs}
+    return CircuitBreaker(name, func, **params)
+
+
+def test_opens_after_threshold_and_recovers():
+    func = Filter()
+    breaker = get_breaker(func)
+    assert breaker(ip_addr="10.0.0.10") == "02:00:00:00:00:10"
+
+    func.error = OSError("nft failure")
+    # last known answer, then default
+    assert breaker(ip_addr="10.0.0.10") == "02:00:00:00:00:10"
+    assert breaker.state == breaker.CLOSED
+    assert breaker(ip_addr="10.0.0.11") == DEFAULT_IDENTIFIER
+    assert breaker.state == breaker.OPEN
+
+    # short-circuited while open
+    calls = func.calls
+    func.error = None
+    assert breaker(ip_addr="10.0.0.11") == DEFAULT_IDENTIFIER
+    assert func.calls == calls
+
+    # failed trial reopens
+    time.sleep(0.2)
+    func.error = OSError("nft failure")
+    assert breaker(ip_addr="10.0.0.11") == DEFAULT_IDENTIFIER
+    assert func.calls == calls + 1
+    assert breaker.state == breaker.OPEN
+
+    # successful trial closes
+    time.sleep(0.2)
+    func.error = None
+    assert breaker(ip_addr="10.0.0.11") == "02:00:00:00:00:11"
+    assert breaker.state == breaker.CLOSED
+    assert breaker.counts["errors"] == 3
+    assert breaker.counts["short_circuited"] == 1
+
+
+def test_success_resets_failures():
+    func = Filter()
+    breaker = get_breaker(func)
+    for _ in range(3):
+        func.error = OSError("nft failure")
+        breaker(ip_addr="10.0.0.10")
+        func.error = None
+        breaker(ip_addr="10.0.0.10")
+    assert breaker.state == breaker.CLOSED
+
+
+def test_timeouts_bound_latency():
+    func = Filter()
+    func.release.clear()
+    breaker = get_breaker(func, name="is_client_active", threshold=10)
+    started = time.monotonic()
+    assert breaker(ip_addr="10.0.0.10") is True
+    assert time.monotonic() - started < 0.5
+    assert breaker.counts["timeouts"] == 1
+    func.release.set()
+
+
+def test_hung_calls_are_bounded_per_breaker():
+    hung = Filter()
+    hung.release.clear()
+    breaker = get_breaker(hung, name="is_client_active", threshold=100)
+    for index in range(breaker.max_in_flight):
+        breaker(ip_addr=f"10.0.0.{index}")
+    assert breaker.in_flight == breaker.max_in_flight
+    assert hung.calls == breaker.max_in_flight
+
+    # not submitted anymore, within budget
+    started = time.monotonic()
+    assert breaker(ip_addr="10.0.0.99") is True
+    assert time.monotonic() - started < 0.5
+    assert hung.calls == breaker.max_in_flight
+    assert breaker.counts["saturated"] == 1
+
+    # other functions are not affected
+    other = get_breaker(Filter())
+    assert other(ip_addr="10.0.0.10") == "02:00:00:00:00:10"
+
+    hung.release.set()
+    deadline = time.monotonic() + 5
+    while breaker.in_flight and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert breaker.in_flight == 0
+    assert breaker(ip_addr="10.0.0.10") == "02:00:00:00:00:10"
+
+
+def test_saturation_does_not_open_breaker():
+    hung = Filter()
+    hung.release.clear()
+    breaker = get_breaker(hung, threshold=2, max_in_flight=1)
+    breaker(ip_addr="10.0.0.10")
+    assert breaker.failures == 1
+    for _ in range(3):
+        breaker(ip_addr="10.0.0.11")
+    assert breaker.counts["saturated"] == 3
+    assert breaker.failures == 1
+    assert breaker.state == breaker.CLOSED
+    hung.release.set()
+
+
+def test_saturated_trial_is_attempted_again():
+    hung = Filter()
+    hung.release.clear()
+    breaker = get_breaker(hung, threshold=1, max_in_flight=1)
+    breaker(ip_addr="10.0.0.10")
+    assert breaker.state == breaker.OPEN
+
+    time.sleep(0.2)
+    # trial call can't be submitted: not a failed trial
+    assert breaker(ip_addr="10.0.0.10") == DEFAULT_IDENTIFIER
+    assert breaker.state == breaker.OPEN
+    hung.release.set()
+    assert breaker(ip_addr="10.0.0.10") == "02:00:00:00:00:10"
+    assert breaker.state == breaker.CLOSED
+
+
+def test_concurrent_calls_wait_for_a_slot():
+    func = Filter()
+    func.delay = 0.02
+    breaker = get_breaker(func, timeout=1, max_in_flight=2)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(
+            executor.map(
+                lambda index: breaker(ip_addr=f"10.0.0.{index}"), range(10, 26)
+            )
+        )
+    assert results == [f"02:00:00:00:00:{index}" for index in range(10, 26)]
+    assert not breaker.counts["saturated"]
+    assert not breaker.counts["degraded"]
+
+
+def test_pool_sized_from_request_threads(monkeypatch):
+    monkeypatch.setattr(Conf, "request_threads", 8)
+    assert get_breaker(Filter()).max_in_flight == 16
+
+
+def test_hung_conntrack_is_killed(monkeypatch, tmp_path):
+    script = tmp_path / "conntrack"
+    script.write_text("#!/bin/sh\nexec sleep 30\n")
+    script.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{tmp_path}:{os.environ['PATH']}")
+    monkeypatch.setattr(portal_filter, "CONNTRACK_TIMEOUT", 0.2)
+
+    started = time.monotonic()
+    with pytest.raises(subprocess.TimeoutExpired):
+        portal_filter.has_active_connection("10.0.0.10")
+    assert time.monotonic() - started < 5
+
+
+@pytest.fixture
+def table(monkeypatch, tmp_path):
+    table = shared_table.SharedTable(tmp_path / "table", 64)
+    monkeypatch.setattr(shared_table, "table", table)
+    return table
+
+
+def test_degraded_answers_are_not_shared(table):
+    func = Filter()
+    func.error = OSError("nft failure")
+    get_identifier_for = shared_table.cached_identifier_for(get_breaker(func))
+    assert get_identifier_for(ip_addr="10.0.0.10") == DEFAULT_IDENTIFIER
+    assert table.get("10.0.0.10") is None
+
+    # other workers still get actual answers once the filter recovers
+    func.error = None
+    assert get_identifier_for(ip_addr="10.0.0.10") == "02:00:00:00:00:10"
+    assert table.get("10.0.0.10").hw_addr == "02:00:00:00:00:10"
+
+
+def test_degraded_verdicts_are_not_shared(table):
+    hung = Filter()
+    hung.release.clear()
+    is_client_active = shared_table.cached_client_active(
+        get_breaker(hung, name="is_client_active")
+    )
+    assert is_client_active(ip_addr="10.0.0.10") is True
+    hung.release.set()
+    assert table.get("10.0.0.10") is None
+
+    failing = Filter()
+    failing.error = OSError("nft failure")
+    ip_in_passlist = shared_table.cached_in_passlist(
+        get_breaker(failing, name="ip_in_passlist")
+    )
+    table.update("10.0.0.11", hw_addr="02:00:00:00:00:11")
+    assert ip_in_passlist(ip_addr="10.0.0.11") is False
+    assert table.get("10.0.0.11").passlist_on == 0.0
@@ -0,0 +1,113 @@
+import os
+import time
+
+import portal_filter
+from portal_filter.leases import EVENT_HEADER, InotifyWatcher, LeaseIndex, parse_leases
+
+LEASES = """\
+1700000000 AA:BB:CC:00:00:01 192.168.2.10 phone 01:aa:bb:cc:00:00:01
+1700000100 aa:bb:cc:00:00:02 192.168.2.11 * *
+duid 00:01:00:01:2c:5f:1a:2b:aa:bb:cc:00:00:09
+1700000200 12345678 fd00::10 laptop 00:01:00:01:2c:5f
+1700000300 20:aa:bb:cc:00:00:03 192.168.2.12 ib-node *
+1700000400 aa:bb:cc:00:00:04 not-an-ip * *
+truncated-line
+"""
+
+
+def test_parse_leases():
+    assert parse_leases(LEASES) == {
+        "192.168.2.10": "aa:bb:cc:00:00:01",
+        "192.168.2.11": "aa:bb:cc:00:00:02",
+    }
+    assert parse_leases("") == {}
+
+
+def pack_event(name: bytes, padded_to: int = 16) -> bytes:
+    length = len(name) + (-len(name) % padded_to) if name else 0
+    return EVENT_HEADER.pack(1, 2, 0, length) + name.ljust(length, b"\0")
+
+
+def test_parse_names():
+    data = pack_event(b"dnsmasq.leases") + pack_event(b"other") + pack_event(b"")
+    assert InotifyWatcher.parse_names(data) == {"dnsmasq.leases", "other", ""}
+    # truncated trailing header is ignored
+    assert InotifyWatcher.parse_names(pack_event(b"a") + b"\0" * 4) == {"a"}
+    assert InotifyWatcher.parse_names(b"") == set()
+
+
+def test_reload_updates_in_place(tmp_path):
+    path = tmp_path / "dnsmasq.leases"
+    index = LeaseIndex(path)
+    index.reload()
+    assert index.entries == {}
+
+    path.write_text(LEASES)
+    entries = index.entries
+    index.reload()
+    assert index.entries is entries
+    assert index.addresses_of("AA:BB:CC:00:00:01") == ["192.168.2.10"]
+
+    path.write_text("1700000100 aa:bb:cc:00:00:05 192.168.2.11 * *\n")
+    index.reload()
+    assert index.entries == {"192.168.2.11": "aa:bb:cc:00:00:05"}
+
+
+def test_watcher_picks_up_changes(tmp_path):
+    path = tmp_path / "dnsmasq.leases"
+    path.write_text(LEASES)
+    index = LeaseIndex(path)
+    assert index.get("192.168.2.10") == "aa:bb:cc:00:00:01"
+
+    # dnsmasq-like rewrite: new file moved over the previous one
+    tmp_file = tmp_path / "dnsmasq.leases.new"
+    tmp_file.write_text("1700000500 aa:bb:cc:00:00:06 192.168.2.20 * *\n")
+    os.replace(tmp_file, path)
+
+    deadline = time.monotonic() + 5
+    while index.get("192.168.2.20") is None and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert index.get("192.168.2.20") == "aa:bb:cc:00:00:06"
+    assert index.get("192.168.2.10") is None
+
+
+def test_clear_passlist_reads_neighbors_once(monkeypatch, nft_table):
+    hw_addrs = [f"aa:bb:cc:00:01:{index:02x}" for index in range(20)]
+    neighbors = {
+        f"192.168.2.{index}": hw_addr for index, hw_addr in enumerate(hw_addrs)
+    }
+    reads = []
+    commands = []
+
+    def get_neighbors():
+        reads.append(1)
+        return neighbors
+
+    monkeypatch.setattr(portal_filter, "PASSLIST_MODE", "mac")
+    monkeypatch.setattr(portal_filter, "ACTIVITY_SOURCE", "conntrack")
+    monkeypatch.setattr(portal_filter, "IDENTITY_SOURCES", ["neighbors"])
+    monkeypatch.setattr(portal_filter, "get_neighbors", get_neighbors)
+    monkeypatch.setattr(
+        portal_filter,
+        "get_passlist_elements",
+        lambda: {hw_addr: (0, 0) for hw_addr in hw_addrs},
+    )
+    # even last byte are active
+    monkeypatch.setattr(
+        portal_filter,
+        "has_active_connection",
+        lambda ip_addr: int(ip_addr.rsplit(".", 1)[1]) % 2 == 0,
+    )
+    monkeypatch.setattr(
+        portal_filter,
+        "query_netfilter_bulk",
+        lambda rules: (commands.extend(rules) or True, []),
+    )
+
+    portal_filter.clear_passlist()
+    assert len(reads) == 1
+    assert commands == [
+        f"delete element ip nat CAPTIVE_PASSLIST_MACS {{ {hw_addr} }}"
+        for hw_addr in hw_addrs[1::2]
+    ]
+    assert portal_filter.get_addresses_for(hw_addrs[3].upper()) == ["192.168.2.3"]
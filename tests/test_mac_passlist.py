@@ -0,0 +1,134 @@
+import fake_nftables
+import pytest
+
+import portal_filter
+
+MACS_SET = portal_filter.PASSLIST_MACS_SET
+
+
+@pytest.fixture
+def mac_table(monkeypatch, leases):
+    """stand-in nat table as left by setup_capture in mac PASSLIST_MODE"""
+    monkeypatch.setattr(portal_filter, "PASSLIST_MODE", "mac")
+    monkeypatch.setattr(portal_filter, "ACTIVITY_SOURCE", "conntrack")
+    fake_nftables.table = fake_nftables.Table(macs_set=MACS_SET)
+    leases(
+        {
+            "192.168.2.10": "aa:bb:cc:00:00:01",
+            "192.168.2.11": "aa:bb:cc:00:00:02",
+            "192.168.2.12": "aa:bb:cc:00:00:03",
+        }
+    )
+    return fake_nftables.table
+
+
+def members(table) -> list:
+    return sorted(table.sets[MACS_SET][1])
+
+
+def test_initial_setup_adds_set_to_ip_mode_setup(monkeypatch, nft_table):
+    monkeypatch.setattr(portal_filter, "PASSLIST_MODE", "mac")
+    nft_table.allow("192.168.2.10")
+    succeeded, _ = portal_filter.initial_setup()
+    assert succeeded
+    assert MACS_SET in nft_table.sets
+    # accept rule after the two CAPTURED_ADDRESS ones
+    rule = nft_table.chains["CAPTIVE_PASSLIST"][2]["rule"]
+    assert rule["comment"] == "allow hosts"
+    assert rule["expr"][0]["match"]["right"] == f"@{MACS_SET}"
+    # existing IP rule is kept
+    assert portal_filter.get_rule_handle("192.168.2.10")
+
+    rules = len(nft_table.chains["CAPTIVE_PASSLIST"])
+    assert portal_filter.initial_setup() == (True, [])
+    assert len(nft_table.chains["CAPTIVE_PASSLIST"]) == rules
+
+
+def test_get_passlist_elements(mac_table):
+    assert portal_filter.get_passlist_elements() == {}
+    mac_table.allow_mac(MACS_SET, "AA:BB:CC:00:00:01", packets=2)
+    mac_table.allow_mac(MACS_SET, "aa:bb:cc:00:00:02", packets=0)
+    assert portal_filter.get_passlist_elements() == {
+        "aa:bb:cc:00:00:01": (2, 128),
+        "aa:bb:cc:00:00:02": (0, 0),
+    }
+
+    # IP rules (former ip mode) and MACs
+    mac_table.allow("192.168.2.20", packets=1)
+    assert portal_filter.get_passlist_counters() == {
+        "192.168.2.20": (1, 64),
+        "aa:bb:cc:00:00:01": (2, 128),
+        "aa:bb:cc:00:00:02": (0, 0),
+    }
+
+    del mac_table.sets[MACS_SET]
+    assert portal_filter.get_passlist_elements() is None
+    assert portal_filter.get_passlist_counters() is None
+
+
+def test_ack_and_remove(mac_table):
+    assert not portal_filter.ip_in_passlist("192.168.2.10")
+    assert portal_filter.ack_client_registration("192.168.2.10")
+    assert members(mac_table) == ["aa:bb:cc:00:00:01"]
+    assert portal_filter.ip_in_passlist("192.168.2.10") == "aa:bb:cc:00:00:01"
+    assert portal_filter.hw_addr_in_passlist("AA:BB:CC:00:00:01")
+    # already present
+    assert not portal_filter.ack_client_registration("192.168.2.10")
+
+    # unknown HW addr
+    assert not portal_filter.ack_client_registration("192.168.2.99")
+    assert members(mac_table) == ["aa:bb:cc:00:00:01"]
+
+    assert portal_filter.remove_from_passlist("192.168.2.10")
+    assert members(mac_table) == []
+    assert not portal_filter.hw_addr_in_passlist("aa:bb:cc:00:00:01")
+    assert not portal_filter.remove_from_passlist("192.168.2.10")
+
+
+def test_remove_former_ip_rule(mac_table):
+    mac_table.allow("192.168.2.10")
+    assert portal_filter.ip_in_passlist("192.168.2.10")
+    assert portal_filter.remove_from_passlist("192.168.2.10")
+    assert not portal_filter.ip_in_passlist("192.168.2.10")
+
+
+def test_clear_passlist(monkeypatch, mac_table):
+    for hw_addr in ("aa:bb:cc:00:00:01", "aa:bb:cc:00:00:02", "aa:bb:cc:00:00:03"):
+        mac_table.allow_mac(MACS_SET, hw_addr)
+    mac_table.allow("192.168.2.20")
+    # .10 (aa:bb:cc:00:00:01) and .20 have established connections
+    monkeypatch.setattr(
+        portal_filter,
+        "has_active_connection",
+        lambda ip_addr: ip_addr in ("192.168.2.10", "192.168.2.20"),
+    )
+
+    portal_filter.clear_passlist(inactives_only=True)
+    assert members(mac_table) == ["aa:bb:cc:00:00:01"]
+    assert portal_filter.get_rule_handle("192.168.2.20")
+
+    portal_filter.clear_passlist(inactives_only=False)
+    assert members(mac_table) == []
+    assert not portal_filter.get_rule_handle("192.168.2.20")
+    # set's accept rule is kept
+    assert mac_table.chains["CAPTIVE_PASSLIST"][2]["rule"]["comment"] == "allow hosts"
+
+
+def test_migrate_former_ip_rule(mac_table, leases):
+    mac_table.allow("192.168.2.20")
+    leases({"192.168.2.21": "aa:bb:cc:00:00:01"})
+    assert portal_filter.migrate_client(
+        hw_addr="aa:bb:cc:00:00:01",
+        old_ip_addr="192.168.2.20",
+        new_ip_addr="192.168.2.21",
+    )
+    assert not portal_filter.get_rule_handle("192.168.2.20")
+    assert members(mac_table) == ["aa:bb:cc:00:00:01"]
+    assert portal_filter.ip_in_passlist("192.168.2.21") == "aa:bb:cc:00:00:01"
+
+    # MAC-keyed entries need no migration
+    assert not portal_filter.migrate_client(
+        hw_addr="aa:bb:cc:00:00:01",
+        old_ip_addr="192.168.2.21",
+        new_ip_addr="192.168.2.22",
+    )
@@ -0,0 +1,115 @@
+import pytest
+
+import portal_filter
+from portal import database
+from portal.backends import MemoryBackend
+from portal.constants import DEFAULT_IDENTIFIER, Conf
+from portal.database import User
+
+
+class SharedBackend(MemoryBackend):
+    """records shared with other nodes, as with kv backend"""
+
+    is_shared = True
+
+
+def passlisted(*ip_addrs):
+    return [bool(portal_filter.get_rule_handle(ip_addr)) for ip_addr in ip_addrs]
+
+
+@pytest.mark.parametrize("hw_addr", [DEFAULT_IDENTIFIER, "AA:BB:CC:DD:EE:FF", "", "x"])
+def test_filter_never_migrates_unidentified(nft_table, leases, hw_addr):
+    nft_table.allow("10.0.0.10")
+    assert not portal_filter.migrate_client(
+        hw_addr=hw_addr, old_ip_addr="10.0.0.10", new_ip_addr="10.0.0.11"
+    )
+    assert passlisted("10.0.0.10", "10.0.0.11") == [True, False]
+
+
+def test_filter_migrates_device(nft_table, leases):
+    nft_table.allow("10.0.0.10")
+    # lease of old IP expired
+    assert portal_filter.migrate_client(
+        hw_addr="aa:bb:cc:00:00:01", old_ip_addr="10.0.0.10", new_ip_addr="10.0.0.11"
+    )
+    assert passlisted("10.0.0.10", "10.0.0.11") == [False, True]
+
+    # not passlisted: nothing to migrate
+    assert not portal_filter.migrate_client(
+        hw_addr="aa:bb:cc:00:00:01", old_ip_addr="10.0.0.12", new_ip_addr="10.0.0.13"
+    )
+
+    # old IP still leased to it
+    nft_table.allow("10.0.0.12")
+    leases({"10.0.0.12": "aa:bb:cc:00:00:01"})
+    assert portal_filter.migrate_client(
+        hw_addr="AA:BB:CC:00:00:01", old_ip_addr="10.0.0.12", new_ip_addr="10.0.0.13"
+    )
+    assert passlisted("10.0.0.12", "10.0.0.13") == [False, True]
+
+
+def test_filter_keeps_rule_of_ip_reassigned(nft_table, leases):
+    # device left 10.0.0.10, leased since to a device that registered
+    nft_table.allow("10.0.0.10")
+    leases({"10.0.0.10": "aa:bb:cc:00:00:02", "10.0.0.11": "aa:bb:cc:00:00:01"})
+    assert not portal_filter.migrate_client(
+        hw_addr="aa:bb:cc:00:00:01", old_ip_addr="10.0.0.10", new_ip_addr="10.0.0.11"
+    )
+    assert passlisted("10.0.0.10", "10.0.0.11") == [True, False]
+
+
+@pytest.fixture
+def migrations(monkeypatch):
+    calls = []
+    monkeypatch.setattr(database, "backend", SharedBackend())
+    monkeypatch.setattr(database, "shared_table", None)
+    monkeypatch.setattr(
+        database, "migrate_client", lambda **kwargs: calls.append(kwargs)
+    )
+    return calls
+
+
+def test_unidentified_clients_are_not_migrated(migrations):
+    # client A registered, then unidentified client B shows up
+    User.create_or_update(DEFAULT_IDENTIFIER, "10.0.0.10", {}).register()
+    User.create_or_update(DEFAULT_IDENTIFIER, "10.0.0.11", {})
+    assert migrations == []
+
+
+def test_device_with_new_ip_is_migrated(migrations):
+    User.create_or_update("aa:bb:cc:00:00:01", "10.0.0.10", {}).register()
+    User.create_or_update("aa:bb:cc:00:00:01", "10.0.0.10", {})
+    assert migrations == []
+
+    user = User.create_or_update("aa:bb:cc:00:00:01", "10.0.0.11", {})
+    assert user.ip_addr == "10.0.0.11"
+    assert migrations == [
+        {
+            "hw_addr": "aa:bb:cc:00:00:01",
+            "old_ip_addr": "10.0.0.10",
+            "new_ip_addr": "10.0.0.11",
+        }
+    ]
+
+
+def test_ip_recorded_by_other_node_is_not_migrated(migrations, monkeypatch):
+    # same 192.168.2.0/24 network on each node
+    User.create_or_update("aa:bb:cc:00:00:01", "192.168.2.10", {}).register()
+    monkeypatch.setattr(Conf, "node_name", "other-node")
+    User.create_or_update("aa:bb:cc:00:00:01", "192.168.2.20", {})
+    assert migrations == []
+
+    # then moves on other node's network
+    user = User.create_or_update("aa:bb:cc:00:00:01", "192.168.2.21", {})
+    assert user.last_seen_by == "other-node"
+    assert [call["old_ip_addr"] for call in migrations] == ["192.168.2.20"]
+
+
+def test_ip_recorded_locally_is_migrated(monkeypatch, migrations):
+    # local backend: all records are this node's
+    monkeypatch.setattr(database, "backend", MemoryBackend())
+    monkeypatch.setattr(Conf, "node_name", "other-node")
+    User.create_or_update("aa:bb:cc:00:00:01", "192.168.2.10", {})
+    monkeypatch.setattr(Conf, "node_name", "renamed-node")
+    User.create_or_update("aa:bb:cc:00:00:01", "192.168.2.11", {})
+    assert len(migrations) == 1
@@ -0,0 +1,153 @@
+import time
+
+import pytest
+
+from portal import database, shared_table
+from portal.backends import MemoryBackend
+from portal.database import User
+from portal.shared_table import (
+    FLAG_ACTIVE,
+    FLAG_PASSLISTED,
+    HEADER,
+    RECORD,
+    SEQ,
+    SharedTable,
+    get_table_path,
+)
+
+
+@pytest.fixture
+def table(tmp_path):
+    return SharedTable(get_table_path(str(tmp_path / "table"), 64), 64)
+
+
+def test_update_and_get(table):
+    assert table.get("192.168.2.10") is None
+    assert table.get("not-an-ip") is None
+
+    table.update("192.168.2.10", hw_addr="AA:BB:CC:00:00:01", platform="Android")
+    table.set_flag("192.168.2.10", FLAG_PASSLISTED, True, passlist_on=10.0)
+    table.set_flag("192.168.2.10", FLAG_ACTIVE, True, active_on=20.0)
+    table.set_flag("192.168.2.10", FLAG_ACTIVE, False, active_on=30.0)
+    entry = table.get("192.168.2.10")
+    assert entry.hw_addr == "aa:bb:cc:00:00:01"
+    assert entry.platform == "android"
+    assert entry.flags == FLAG_PASSLISTED
+    assert (entry.passlist_on, entry.active_on) == (10.0, 30.0)
+    assert table.matches("192.168.2.10", "AA:BB:CC:00:00:01", "android")
+    assert not table.matches("192.168.2.10", "aa:bb:cc:00:00:02", "android")
+
+    # unknown platform and invalid MAC
+    table.update("192.168.2.11", hw_addr="unknown", platform="BeOS")
+    entry = table.get("192.168.2.11")
+    assert (entry.hw_addr, entry.platform) == (None, "other")
+
+
+def test_shared_between_instances(table):
+    other = SharedTable(table.path, table.slots)
+    table.update("192.168.2.10", hw_addr="aa:bb:cc:00:00:01")
+    assert other.get("192.168.2.10").hw_addr == "aa:bb:cc:00:00:01"
+
+
+def test_record_being_written_is_not_read(table):
+    table.update("192.168.2.10", hw_addr="aa:bb:cc:00:00:01")
+    offset = next(table.offsets(shared_table.ip_to_int("192.168.2.10")))
+    seq = SEQ.unpack_from(table.mm, offset)[0]
+    assert seq % 2 == 0
+
+    SEQ.pack_into(table.mm, offset, seq + 1)
+    assert table.get("192.168.2.10") is None
+
+    # writer died mid-write: next update makes it consistent again
+    table.update("192.168.2.10", hw_addr="aa:bb:cc:00:00:02")
+    assert SEQ.unpack_from(table.mm, offset)[0] % 2 == 0
+    assert table.get("192.168.2.10").hw_addr == "aa:bb:cc:00:00:02"
+
+
+def test_least_recently_updated_slot_is_reused(tmp_path):
+    table = SharedTable(tmp_path / "table", 4)
+    # all in the same probe sequence (4 slots)
+    clients = [f"10.0.0.{index}" for index in range(4)]
+    for updated_on, ip_addr in zip([40.0, 10.0, 30.0, 20.0], clients):
+        table.update(ip_addr, hw_addr="aa:bb:cc:00:00:01", mac_on=updated_on)
+
+    table.update("10.0.0.4", hw_addr="aa:bb:cc:00:00:04", mac_on=50.0)
+    assert table.get("10.0.0.1") is None
+    assert table.get("10.0.0.4").hw_addr == "aa:bb:cc:00:00:04"
+    assert table.get("10.0.0.4").flags == 0
+    assert all(table.get(ip_addr) for ip_addr in clients if ip_addr != "10.0.0.1")
+
+
+def test_other_layout_is_not_resized(tmp_path):
+    path = tmp_path / "table"
+    table = SharedTable(path, 4)
+    table.update("10.0.0.1", hw_addr="aa:bb:cc:00:00:01")
+    size = path.stat().st_size
+    assert size == HEADER.size + 4 * RECORD.size
+
+    with pytest.raises(ValueError):
+        SharedTable(path, 8)
+    assert path.stat().st_size == size
+    assert table.get("10.0.0.1").hw_addr == "aa:bb:cc:00:00:01"
+
+    assert get_table_path("/dev/shm/portal", 4) != get_table_path("/dev/shm/portal", 8)
+
+
+@pytest.fixture
+def users_table(monkeypatch, table):
+    calls = []
+
+    def ip_in_passlist(ip_addr):
+        calls.append(ip_addr)
+        return True
+
+    monkeypatch.setattr(database, "backend", MemoryBackend())
+    monkeypatch.setattr(database, "shared_table", table)
+    monkeypatch.setattr(database, "ip_in_passlist", ip_in_passlist)
+    return calls
+
+
+def test_is_registered_from_table(table, users_table):
+    user = User.create_or_update("aa:bb:cc:00:00:01", "192.168.2.10", {})
+    assert table.get("192.168.2.10").registered_until == 0.0
+    # not registered: no passlist check
+    assert not user.is_registered
+    assert users_table == []
+
+    user.register()
+    assert table.get("192.168.2.10").registered_until == user.registered_until
+    # passlist verdict not in table yet
+    assert user.is_registered
+    assert users_table == ["192.168.2.10"]
+
+    table.set_flag("192.168.2.10", FLAG_PASSLISTED, True, passlist_on=time.time())
+    user = User.create_or_update("aa:bb:cc:00:00:01", "192.168.2.10", {})
+    assert user.is_registered
+    assert users_table == ["192.168.2.10"]
+
+    table.set_flag("192.168.2.10", FLAG_PASSLISTED, False, passlist_on=time.time())
+    assert not user.is_registered
+
+    # expired
+    table.set_flag("192.168.2.10", FLAG_PASSLISTED, True)
+    table.update("192.168.2.10", registered_until=time.time() - 1)
+    assert not user.is_registered
+    assert users_table == ["192.168.2.10"]
+
+
+def test_is_registered_not_from_stale_or_other_device(table, users_table):
+    user = User.create_or_update("aa:bb:cc:00:00:01", "192.168.2.10", {})
+    user.register()
+
+    table.set_flag("192.168.2.10", FLAG_PASSLISTED, False, passlist_on=1.0)
+    assert user.is_registered
+    assert users_table == ["192.168.2.10"]
+
+    # another device got the IP
+    other = User.create_or_update("aa:bb:cc:00:00:02", "192.168.2.10", {})
+    table.set_flag("192.168.2.10", FLAG_PASSLISTED, True, passlist_on=time.time())
+    assert table.get("192.168.2.10").registered_until == 0.0
+    assert not other.is_registered
+    # entry is the other device's: checked via filter
+    assert user.is_registered
+    assert users_table == ["192.168.2.10"] * 2
@@ -0,0 +1,74 @@
+import hashlib
+import json
+
+import flask
+import pytest
+
+from portal.trace import Recorder
+
+
+@pytest.fixture
+def recorded(tmp_path):
+    """app recording its requests, and a reader of recorded entries"""
+    path = tmp_path / "trace.jsonl"
+    app = flask.Flask(__name__)
+    recorder = Recorder(str(path), "salt")
+    app.before_request(recorder.before_request)
+    app.after_request(recorder.after_request)
+
+    @app.route("/<path:u_path>")
+    def page(u_path):
+        return "", 204
+
+    def read():
+        return [json.loads(line) for line in path.read_text().splitlines()]
+
+    return app.test_client(), path, read
+
+
+def test_line_format(recorded):
+    client, path, read = recorded
+    client.get(
+        "/hotspot-detect.html?token=secret",
+        base_url="http://captive.apple.com",
+        headers={"User-Agent": "CaptiveNetworkSupport-481.0.1 wispr"},
+    )
+    client.get("/generate_204", headers={"User-Agent": "curl/8.5.0"})
+
+    # compact, one JSON object per line
+    lines = path.read_text().splitlines()
+    assert len(lines) == 2
+    assert ", " not in lines[0] and ": " not in lines[0]
+
+    first, second = read()
+    assert set(first) == {"t", "d", "m", "h", "p", "ua", "c", "s"}
+    assert first["m"] == "GET"
+    assert first["h"] == "captive.apple.com"
+    assert first["p"] == "/hotspot-detect.html"
+    assert (first["ua"], second["ua"]) == ("apple", "other")
+    assert first["s"] == 204
+    assert first["d"] >= 0
+    assert second["t"] >= first["t"]
+
+
+def test_clients_are_anonymised(recorded):
+    client, path, read = recorded
+    for ip_addr in ("192.168.2.10", "192.168.2.10", "192.168.2.11"):
+        client.get("/", headers={"X-Forwarded-For": ip_addr})
+
+    first, again, other = (entry["c"] for entry in read())
+    assert first == again != other
+    assert len(first) == 12
+    assert "192.168.2.10" not in path.read_text()
+    # salted: not the plain hash of the IP
+    assert first == hashlib.sha256(b"salt192.168.2.10").hexdigest()[:12]
+    assert first != hashlib.sha256(b"192.168.2.10").hexdigest()[:12]
+
+
+def test_salt_changes_identities(tmp_path):
+    ids = [
+        Recorder(str(tmp_path / "trace.jsonl"), salt).client_id("192.168.2.10")
+        for salt in ("salt", "other-salt", "salt")
+    ]
+    assert ids[0] != ids[1]
+    assert ids[0] == ids[2]